@@ -6,7 +6,20 @@
 #      This code is licensed under the GPL         #
 #                                                  #
 
+import os
+import re
+import sys
 import json
+import shutil
+import argparse
+import unicodedata
+
+CORE_ENTITY_REGISTRY = 'core.entity_registry'
+CORE_AREA_REGISTRY = 'core.area_registry'
+DEFAULT_MENU_PREFIX = 'ovum_'
+
+# Sensor names of ovModbus.py --hass: "<menu>: <descriptor> (<code> #<address>)", templates end with " tmpl"
+MENU_NAME = re.compile(r'^(?P<menu>[^:]+): .* \(\w* #\d+\)')
 
 def load_json(filename):
     try:
@@ -16,43 +29,164 @@ def load_json(filename):
         print(f'Error: {filename} file not found')
         return {}
 
-def save_output(filename, content, init=False):
+# Write to a temporary file next to the target and replace the target in one step
+def save_json_atomic(filename, content):
     try:
-        mode = "w" if init else "a"
-        with open(filename, mode, encoding='UTF-8') as file:
-            file.write(content)
-    except PermissionError:
-        print(f"Error: You do not have permission to write to '{filename}'.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-
-def update_area_id(obj, unique_id_starts_with, area_id):
-    if isinstance(obj, dict):
-        if 'unique_id' in obj and obj['unique_id'].startswith(unique_id_starts_with):
-            obj['area_id'] = area_id
-        for key, value in obj.items():
-            obj[key] = update_area_id(value)
-    elif isinstance(obj, list):
-        for i, item in enumerate(obj):
-            obj[i] = update_area_id(item)
-    return obj
+        with open(f"{filename}.tmp", "w", encoding='UTF-8') as file:
+            json.dump(content, file, indent=2, ensure_ascii=False)
+        os.replace(f"{filename}.tmp", filename)
+        return True
+    except OSError as e:
+        print(f"Error: Could not write '{filename}': {e}")
+        return False
 
-def main():
-    ### CONFIGURATION
-    ##
-    UNIQUE_ID_STARTS_WITH = 'ovum_'
-    AREA_ID = 'ovum_warmepumpe'
-    #
-    ################################
+# Area id as Home Assistant derives it from a name: lower case, ascii, words joined by '_'
+def slugify(text):
+    text = unicodedata.normalize('NFKD', text.replace('ß', 'ss')).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^a-z0-9]+', '_', text.lower()).strip('_')
+
+# Rules as [(kind, pattern, area)] in the order of the rules file and the command line: "prefix" and "regex"
+# match the unique_id, "menu" derives the area from the menu in the sensor name for unique_ids starting with pattern
+def load_rules(args):
+    rules = []
+    if args.rules:
+        for rule in load_json(args.rules):
+            if "menu" in rule:
+                rules.append(("menu", rule["menu"], rule.get("area_prefix", "")))
+            elif "regex" in rule:
+                rules.append(("regex", rule["regex"], rule["area"]))
+            else:
+                rules.append(("prefix", rule["prefix"], rule["area"]))
+    for kind, text in args.cli_rules:
+        if kind == "menu":
+            rules.append((kind, text, args.area_prefix))
+            continue
+        pattern, separator, area = text.rpartition("=")
+        if not separator or not pattern or not area:
+            raise ValueError(f"'{text}' is not PATTERN=AREA")
+        rules.append((kind, pattern, area))
+    return rules
+
+# Matcher per rule, compiled once: prefixes match at the start of the unique_id, regexes anywhere in it
+def compile_rules(rules):
+    return [re.compile(re.escape(pattern)).match if kind != "regex" else re.compile(pattern).search for kind, pattern, _ in rules]
+
+# Area ids by id and by lower case name of the area registry, None without a registry
+def load_areas(filename):
+    if not filename or not os.path.exists(filename):
+        return None
+    areas = {}
+    for area in load_json(filename).get("data", {}).get("areas", []):
+        areas[area["id"]] = area["id"]
+        areas.setdefault(area.get("name", "").lower(), area["id"])
+    return areas
 
-    CORE_ENTITY_REGISTRY = 'core.entity_registry'
-    CORE_ENTITY_REGISTRY_NEW = CORE_ENTITY_REGISTRY + '.new'
+def menu_area(entity, area_prefix, areas):
+    match = MENU_NAME.match(entity.get("original_name") or entity.get("name") or "")
+    if match is None:
+        return None, None
+    menu = match.group("menu").strip()
+    if areas is None:
+        return f"{area_prefix}{slugify(menu)}", menu
+    return areas.get(menu.lower(), areas.get(f"{area_prefix}{slugify(menu)}")), menu
+
+# Apply the rules to all entities in one pass, returns the changes as [(entity_id, old area, new area)] and the
+# counts of the summary. The first matching rule with an area sets it, a menu rule without an area for the
+# menu or a rule with an area missing in the area registry falls through to the next rules.
+def assign_areas(entities, rules, matchers, areas, keep):
+    changes = []
+    counts = {"entities": len(entities), "matched": 0, "unchanged": 0, "kept": 0}
+    missing = {}
+    for entity in entities:
+        unique_id = entity.get("unique_id") or ""
+        area = None
+        unresolved = None
+        for (kind, _, rule_area), matcher in zip(rules, matchers):
+            if not matcher(unique_id):
+                continue
+            if kind == "menu":
+                rule_area, menu = menu_area(entity, rule_area, areas)
+                if rule_area is None:
+                    unresolved = unresolved or menu
+                    continue
+            elif areas is not None and rule_area not in areas:
+                unresolved = unresolved or rule_area
+                continue
+            area = rule_area
+            break
+        if area is None:
+            if unresolved is not None:
+                missing[unresolved] = missing.get(unresolved, 0) + 1
+            continue
+        counts["matched"] += 1
+        if entity.get("area_id") == area:
+            counts["unchanged"] += 1
+        elif keep and entity.get("area_id"):
+            counts["kept"] += 1
+        else:
+            changes.append((entity.get("entity_id"), entity.get("area_id"), area))
+            entity["area_id"] = area
+    return changes, counts, missing
+
+def print_summary(changes, counts, missing, verbose):
+    print(f"Entities: {counts['entities']}, matched: {counts['matched']}, changed: {len(changes)}, unchanged: {counts['unchanged']}, kept: {counts['kept']}")
+    per_area = {}
+    for _, _, area in changes:
+        per_area[area] = per_area.get(area, 0) + 1
+    for area, count in sorted(per_area.items()):
+        print(f"  {area}: {count}")
+    for name, count in sorted(missing.items()):
+        print(f"Warning: No area '{name}' in the area registry, {count} entities not assigned")
+    if verbose:
+        for entity_id, old, new in changes:
+            print(f"{entity_id}: {old} -> {new}")
+
+def init_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--registry', type=str, default=CORE_ENTITY_REGISTRY, help='Entity registry of Home Assistant (storage folder)')
+    parser.add_argument('--areas', type=str, default=CORE_AREA_REGISTRY, help='Area registry to check the area ids and to find the areas of menus by name')
+    parser.add_argument('--prefix', dest='cli_rules', type=lambda text: ("prefix", text), action='append', default=[], help='Rule PREFIX=AREA for unique_ids starting with PREFIX, can be repeated')
+    parser.add_argument('--regex', dest='cli_rules', type=lambda text: ("regex", text), action='append', default=[], help='Rule REGEX=AREA for unique_ids containing a match of REGEX, can be repeated')
+    parser.add_argument('--menu', dest='cli_rules', type=lambda text: ("menu", text), action='append', nargs='?', const=("menu", DEFAULT_MENU_PREFIX), help=f'Rule: area of the menu in the sensor name for unique_ids starting with this prefix (default {DEFAULT_MENU_PREFIX})')
+    parser.add_argument('--area_prefix', type=str, default="", help='Prefix of the area ids derived from menu names, e.g. ovum_')
+    parser.add_argument('--rules', type=str, default=None, help='JSON file with a list of rules: {"prefix": .., "area": ..}, {"regex": .., "area": ..} or {"menu": .., "area_prefix": ..}')
+    parser.add_argument('--keep', action='store_true', help='Keep the area of entities that already have one')
+    parser.add_argument('--output', type=str, default=None, help='File of the new registry (default: registry + .new)')
+    parser.add_argument('--in_place', action='store_true', help='Replace the registry, the old one is kept as .bak')
+    parser.add_argument('--dry_run', action='store_true', help='Only print the summary')
+    parser.add_argument('--verbose', action='store_true', help='List every changed entity')
+    return parser
+
+def main():
+    args = init_parser().parse_args()
+    try:
+        rules = load_rules(args)
+        if not rules:
+            print("Error: No rules, use --prefix, --regex, --menu or --rules")
+            sys.exit(1)
+        matchers = compile_rules(rules)
+    except re.error as e:
+        print(f"Error: Invalid regex '{e.pattern}': {e}")
+        sys.exit(1)
+    except (ValueError, KeyError) as e:
+        print(f"Error: Invalid rule: {e}")
+        sys.exit(1)
 
-    data = load_json(CORE_ENTITY_REGISTRY)
-    updated_data = update_area_id(data, UNIQUE_ID_STARTS_WITH, AREA_ID)
+    data = load_json(args.registry)
+    entities = data.get("data", {}).get("entities")
+    if entities is None:
+        print(f"Error: {args.registry} is not an entity registry")
+        sys.exit(1)
+    changes, counts, missing = assign_areas(entities, rules, matchers, load_areas(args.areas), args.keep)
+    print_summary(changes, counts, missing, args.verbose)
+    if args.dry_run or not changes:
+        return
 
-    save_output(CORE_ENTITY_REGISTRY + '.new', json.dumps(updated_data, indent=2, ensure_ascii=False), True)
-    print('New file created: ' + CORE_ENTITY_REGISTRY_NEW)
+    output = args.registry if args.in_place else args.output or f"{args.registry}.new"
+    if args.in_place:
+        shutil.copy2(args.registry, f"{args.registry}.bak")
+    if save_json_atomic(output, data):
+        print('New file created: ' + output)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import subprocess
+import pytest
+
+TOOL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tool')
+sys.path.insert(0, TOOL_DIR)
+
+import ovModbus
+import ovSimulator
+
+PARAMETERS = 100
+STOP_ADDRESS = ovModbus.DEFAULT_START_ADDRESS + PARAMETERS * ovModbus.PARAMETER_BLOCK_SIZE - 1
+
+# Simulated device in a background thread, scan() runs ovModbus.py against it and returns the output
+# and the requests the simulator counted
+class Device:
+    def __init__(self, exception_ranges=()):
+        # synthetic_registers loads the json-files relative to the tool folder
+        cwd = os.getcwd()
+        os.chdir(TOOL_DIR)
+        try:
+            self.simulator = ovSimulator.OvumSimulator(ovSimulator.synthetic_registers(PARAMETERS), exception_ranges=exception_ranges)
+        finally:
+            os.chdir(cwd)
+        self.port = ovSimulator.run_in_thread(self.simulator)
+
+    def scan(self, tmp_path, *options, stop_address=STOP_ADDRESS):
+        output = tmp_path / f"scan{len(list(tmp_path.iterdir()))}.txt"
+        before = self.simulator.stats["requests"]
+        command = [sys.executable, "ovModbus.py", ovModbus.METHOD_TCP, f"{ovModbus.DEFAULT_SLAVE}", "--port", f"{self.port}", "--stop_address", f"{stop_address}",
+                   "--cache_dir", f"{tmp_path / 'cache'}", "--output", f"{output}"] + [f"{option}" for option in options]
+        subprocess.run(command, cwd=TOOL_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return output.read_text(encoding='UTF-8'), self.simulator.stats["requests"] - before
+
+@pytest.fixture(scope="module")
+def device():
+    return Device()
+
+# Device with one register answered with an exception near the start of the scan
+@pytest.fixture(scope="module")
+def early_exception_device():
+    return Device(exception_ranges=[(12300, 12300)])
+
+# Device with a dead range that starts 2 registers into a parameter block
+@pytest.fixture(scope="module")
+def dead_range_device():
+    return Device(exception_ranges=[(12500, 12599)])
@@ -0,0 +1,71 @@
+import pytest
+import re
+
+# Scenario, options and the most requests for the 1000 registers of the simulator: the probe and
+# 8 dump reads of 125 registers, or 9 reads of 12 parameter blocks
+SCENARIOS = [
+    ("dump", ["--dump"], 9),
+    ("ovum", [], 10),
+    ("hass", ["--hass"], 10),
+    ("dump_async", ["--dump", "--async_scan"], 9),
+    ("ovum_async", ["--async_scan"], 10),
+    ("hass_async", ["--hass", "--async_scan"], 10),
+]
+
+# The output must be the same as with one request per register (per parameter block for the Ovum map)
+@pytest.mark.parametrize("name, options, max_requests", SCENARIOS, ids=[name for name, _, _ in SCENARIOS])
+def test_scan_matches_register_reads(device, tmp_path, name, options, max_requests):
+    output, requests = device.scan(tmp_path, *options)
+    expected, _ = device.scan(tmp_path, *[option for option in options if option != "--async_scan"], "--block_size", "1", "--no_probe")
+    assert output == expected
+    assert requests <= max_requests
+
+# One exception at 12300 costs the first chunk its block read. The probe, the failed read, the first chunk
+# unit by unit (125 registers or 12 parameter blocks) and one read for each of the other chunks
+EARLY_EXCEPTION_SCENARIOS = [
+    ("dump", ["--dump"], 134),
+    ("ovum", [], 22),
+    ("dump_async", ["--dump", "--async_scan"], 134),
+    ("ovum_async", ["--async_scan"], 22),
+]
+
+@pytest.mark.parametrize("name, options, max_requests", EARLY_EXCEPTION_SCENARIOS, ids=[name for name, _, _ in EARLY_EXCEPTION_SCENARIOS])
+def test_early_exception_keeps_block_reads(early_exception_device, tmp_path, name, options, max_requests):
+    output, requests = early_exception_device.scan(tmp_path, *options)
+    expected, _ = early_exception_device.scan(tmp_path, *[option for option in options if option != "--async_scan"], "--block_size", "1", "--no_probe")
+    assert output == expected
+    assert requests <= max_requests
+
+# Every template of --hass_group reads its value from the group sensor (value 0) or from the virtual sensor n
+# of Home Assistant, numbered 1..virtual_count, for the value registers at 2 * n after the group address
+def test_hass_group_templates_read_their_value(device, tmp_path):
+    output, _ = device.scan(tmp_path, "--hass", "--hass_group")
+    groups = {int(address): int(count) for address, count in re.findall(r'unique_id: ovum_group(\d+)\n.*?virtual_count: (\d+)', output, re.DOTALL)}
+    templates = re.findall(r'#(\d+)\)"\n\s+unique_id: \S+\n(?:.*\n)*?\s+state: "\{\{ \(?states\(\'sensor\.ovum_group_(\d+)(?:_(\d+))?\'\)', output)
+    assert groups and len(templates) == output.count("has_value('sensor.ovum_group")
+    for address, group, index in templates:
+        index = int(index or 0)
+        assert 0 <= index <= groups[int(group)]
+        assert int(group) + 2 * index == int(address)
+
+# --discover bisects the dead space and resolves the blocks next to live registers, the dump with the
+# region map must read the same registers as a full dump with a fraction of the requests
+def test_discover_region_map(dead_range_device, tmp_path):
+    regions, requests = dead_range_device.scan(tmp_path, "--discover", "--start_address", "11000")
+    output, cached_requests = dead_range_device.scan(tmp_path, "--dump", "--cache", "--noerror", "--start_address", "11000")
+    expected, _ = dead_range_device.scan(tmp_path, "--dump", "--noerror", "--start_address", "11000", "--block_size", "1", "--no_probe")
+    assert output == expected
+    assert "\t12288\t12499\t212" in regions
+    assert requests <= (13287 - 11000 + 1) // 5
+    assert cached_requests <= 10
+
+# With the layout cache the output stays the same and never takes more requests than the full scan: the Ovum
+# map reads the values and the fingerprint blocks in one plan, --hass only the fingerprint blocks
+@pytest.mark.parametrize("options", [[], ["--hass"]], ids=["ovum", "hass"])
+@pytest.mark.parametrize("fixture", ["device", "early_exception_device"])
+def test_layout_cache(request, tmp_path, fixture, options):
+    device = request.getfixturevalue(fixture)
+    expected, scan_requests = device.scan(tmp_path, *options, "--cache")
+    output, cached_requests = device.scan(tmp_path, *options, "--cache")
+    assert output == expected
+    assert cached_requests <= (4 if "--hass" in options else scan_requests)
@@ -0,0 +1,170 @@
+#                                                  #
+#      ovBench.py  Benchmarks for ovModbus         #
+#                                                  #
+#      Copyright 2023 MiSc                         #
+#                                                  #
+#      This code is licensed under the GPL         #
+#                                                  #
+
+import os
+import sys
+import json
+import random
+import time
+import argparse
+import tempfile
+import subprocess
+import ovModbus
+import ovSimulator
+
+DEFAULT_BLOCKS = 5000
+DEFAULT_REPEAT = 3
+DEFAULT_PARAMETERS = 612
+DEFAULT_LATENCY = 0.005
+
+# Scenario name and ovModbus.py options, async variants are only run for Modbus TCP
+SCAN_SCENARIOS = [
+    ("dump", ["--dump"]),
+    ("ovum", []),
+    ("hass", ["--hass"]),
+    ("dump_async", ["--dump", "--async_scan"]),
+    ("ovum_async", ["--async_scan"]),
+    ("hass_async", ["--hass", "--async_scan"]),
+]
+
+# Random parameter blocks, every 10th block is a menu
+def generate_blocks(count, seed=1):
+    rnd = random.Random(seed)
+    blocks = []
+    for i in range(count):
+        registers = [rnd.randrange(65536) for _ in range(ovModbus.PARAMETER_BLOCK_SIZE)]
+        registers[5] = 0x8000 if i % 10 == 0 else rnd.choice((0, 0x4000))
+        blocks.append((ovModbus.DEFAULT_START_ADDRESS + i * ovModbus.PARAMETER_BLOCK_SIZE, registers))
+    return blocks
+
+# Decoding as done before the typed decoder: string dict per register, fields parsed back from strings
+def legacy_registers(address, registers):
+    response = []
+    for i in range(0, len(registers)):
+        hex = format(registers[i], '04X')
+        dec_unsigned = int(hex, 16)
+        if dec_unsigned & 0x8000:
+            dec_signed = -((dec_unsigned^0xFFFF)+1)
+        else:
+            dec_signed = dec_unsigned
+        byte1 = int(hex[:2], 16)
+        byte2 = int(hex[-2:], 16)
+        char1 = chr(byte1) if (31 < byte1 < 127) and (31 < byte2 < 127) else ""
+        char2 = chr(byte2) if (31 < byte1 < 127) and (31 < byte2 < 127) else ""
+        bin = format(registers[i], '016b')
+        address_dec = address+i
+        data = {"address_hex": f"{address_dec:#0{6}x}", "address": f"{address +i}", "hex": f"{hex}", "byte1": f"{byte1}", "byte2": f"{byte2}", "UInt16": f"{dec_unsigned}", "Int16": f"{dec_signed}", "char1": f"{char1}", "char2": f"{char2}", "bin": f"{bin}"}
+        response.append(data)
+    return response
+
+def legacy_decode(address, registers):
+    response = legacy_registers(address, registers)
+    parameter = f"{response[6]['char1']}{response[6]['char2']}{response[7]['char1']}{response[7]['char2']}"
+    is_not_menu = (int(response[5]['bin'][0], 2) == 0)
+    is_readonly = (int(response[5]['bin'][1], 2) == 0) if is_not_menu else ""
+    if is_not_menu:
+        value = int(f"{response[1]['hex']}{response[0]['hex']}", 16)
+        if value & 0x80000000:
+            value = -((value ^ 0xFFFFFFFF) + 1)
+    else:
+        value = ""
+    precision = int(response[4]['bin'][:4], 2) if is_not_menu else ""
+    unit_id = int(response[4]['bin'][-7:], 2) if is_not_menu else ""
+    multi_id = response[9]['UInt16'] if (is_not_menu and (response[9]['UInt16'] != "0")) else ""
+    if is_not_menu:
+        min_val = int(f"{response[2]['hex']}", 16)
+        if min_val > 32767:
+            min_val -= 65536
+        max_val = int(f"{response[3]['hex']}", 16)
+    else:
+        min_val = ""
+        max_val = ""
+    return (parameter, value, precision, unit_id, multi_id, min_val, max_val, is_readonly, response[8]['UInt16'])
+
+def typed_decode(address, registers):
+    parameter = ovModbus.decode_parameter(address, registers)
+    return (parameter.code, parameter.value, parameter.precision, parameter.unit_id, parameter.multi_id, parameter.min_raw, parameter.max_raw, parameter.is_readonly, parameter.descriptor_id)
+
+def typed_decode_table(blocks):
+    # all blocks as one contiguous register table, decoded in a single pass
+    registers = [value for _, block in blocks for value in block]
+    return list(ovModbus.decode_parameters(blocks[0][0], registers))
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def benchDecode(count, repeat):
+    blocks = generate_blocks(count)
+    results = [
+        ("legacy", measure(lambda: [legacy_decode(address, registers) for address, registers in blocks], repeat)),
+        ("typed", measure(lambda: [typed_decode(address, registers) for address, registers in blocks], repeat)),
+        ("typed_table", measure(lambda: typed_decode_table(blocks), repeat)),
+    ]
+    legacy_time = results[0][1]
+    print(f"Decoding {count} parameter blocks (best of {repeat})")
+    print("Path\tTotal_ms\tus/block\tSpeedup".expandtabs(16))
+    for name, elapsed in results:
+        print(f"{name}\t{elapsed * 1000:.1f}\t{elapsed / count * 1e6:.2f}\t{legacy_time / elapsed:.1f}x".expandtabs(16))
+
+# Run ovModbus.py against the local simulator for every scenario, requests and bytes are counted by the simulator
+def benchScan(parameters, latency, max_count, rtu, baudrate, json_file):
+    simulator = ovSimulator.OvumSimulator(ovSimulator.synthetic_registers(parameters), latency=latency, max_count=max_count, baudrate=baudrate)
+    endpoint = ovSimulator.run_in_thread(simulator, rtu)
+    if rtu:
+        connection = [ovModbus.METHOD_RTU, f"{ovModbus.DEFAULT_SLAVE}", "--comport", endpoint, "--baudrate", f"{baudrate or ovModbus.DEFAULT_BAUDRATE}", "--parity", "N"]
+    else:
+        connection = [ovModbus.METHOD_TCP, f"{ovModbus.DEFAULT_SLAVE}", "--port", f"{endpoint}"]
+    stop_address = ovModbus.DEFAULT_START_ADDRESS + parameters * ovModbus.PARAMETER_BLOCK_SIZE - 1
+    print(f"Scanning {parameters} parameter blocks via {'RTU' if rtu else 'TCP'}, latency {latency * 1000:.1f} ms, max {max_count} registers per request")
+    print("Scenario\tRequests\tBytes\tWall_s\tReq/s".expandtabs(16))
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, options in SCAN_SCENARIOS:
+            if rtu and "--async_scan" in options:
+                continue
+            before = dict(simulator.stats)
+            command = [sys.executable, "ovModbus.py"] + connection + ["--stop_address", f"{stop_address}", "--block_size", f"{max_count}", "--output", os.path.join(directory, name)] + options
+            start_time = time.perf_counter()
+            subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            elapsed = time.perf_counter() - start_time
+            requests = simulator.stats["requests"] - before["requests"]
+            transferred = simulator.stats["bytes_in"] + simulator.stats["bytes_out"] - before["bytes_in"] - before["bytes_out"]
+            results.append({"scenario": name, "requests": requests, "bytes": transferred, "seconds": round(elapsed, 3), "requests_per_second": round(requests / elapsed, 1)})
+            print(f"{name}\t{requests}\t{transferred}\t{elapsed:.2f}\t{requests / elapsed:.1f}".expandtabs(16))
+    if json_file:
+        with open(json_file, "w", encoding='UTF-8') as file:
+            json.dump({"parameters": parameters, "latency": latency, "max_count": max_count, "rtu": rtu, "baudrate": baudrate, "results": results}, file, indent=2)
+
+def init_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', type=str, choices=['decode', 'scan'], help='Benchmark to run')
+    parser.add_argument('--blocks', type=int, default=DEFAULT_BLOCKS, help='Number of parameter blocks to decode')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Repetitions, the best run is reported')
+    parser.add_argument('--parameters', type=int, default=DEFAULT_PARAMETERS, help='Parameter blocks served by the simulator for scan')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help='Simulated delay in seconds per request for scan')
+    parser.add_argument('--max_count', type=int, default=ovModbus.MAX_READ_COUNT, help='Maximum registers per request of the simulator for scan')
+    parser.add_argument('--rtu', action='store_true', help='Run scan via Modbus RTU on a pty')
+    parser.add_argument('--baudrate', type=int, default=0, help='Emulated serial baudrate for scan')
+    parser.add_argument('--json', type=str, default=None, help='Write the scan results to a JSON file')
+    return parser
+
+def main():
+    args = init_parser().parse_args()
+    if args.bench == 'decode':
+        benchDecode(args.blocks, args.repeat)
+    elif args.bench == 'scan':
+        benchScan(args.parameters, args.latency, args.max_count, args.rtu, args.baudrate, args.json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#                                                  #
+#      ovFleet.py  Scan many Ovum devices          #
+#                                                  #
+#      Copyright 2023 MiSc                         #
+#                                                  #
+#      This code is licensed under the GPL         #
+#                                                  #
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import ovModbus
+
+DEFAULT_WORKERS = 4
+DEFAULT_OUTPUT_DIR = 'fleet'
+SUMMARY_FILE = 'fleet-summary.json'
+
+# Command line of ovModbus.py for a device of the inventory, options without value are flags
+def device_argv(device):
+    argv = [f"{device.get('method', ovModbus.METHOD_TCP)}", f"{device.get('slave', ovModbus.DEFAULT_SLAVE)}"]
+    for key, value in device.items():
+        if key in ("name", "method", "slave") or value is False or value is None:
+            continue
+        argv += [f"--{key}"] if value is True else [f"--{key}", f"{value}"]
+    return argv
+
+def device_name(device):
+    if "name" in device:
+        return device["name"]
+    connection = device.get("host", ovModbus.DEFAULT_HOST) if device.get("method", ovModbus.METHOD_TCP) == ovModbus.METHOD_TCP else os.path.basename(device.get("comport", ovModbus.DEFAULT_COMPORT))
+    return f"{connection}_{device.get('slave', ovModbus.DEFAULT_SLAVE)}"
+
+# Devices sharing a connection (TCP host/port or serial port) are scanned one after another in one worker
+def group_devices(devices, output_dir):
+    groups = {}
+    parser = ovModbus.init_parser()
+    for device in devices:
+        args = parser.parse_args(device_argv(device))
+        name = device_name(device)
+        if args.output is None:
+            args.output = os.path.join(output_dir, f"{name}.{'yaml' if args.hass else 'txt'}")
+        if args.method == ovModbus.METHOD_RTU:
+            key = (args.method, args.comport)
+        else:
+            key = (args.method, args.host, args.port)
+        groups.setdefault(key, []).append((name, args))
+    return list(groups.values())
+
+def init_worker(lookup):
+    ovModbus.lookup = lookup
+
+# Scan all devices of a group on one shared connection, opened for the first device that scans synchronously;
+# the devices with --async_scan share one async client
+def scan_group(group):
+    results = []
+    for _, args in group:
+        ovModbus.args = args
+        ovModbus.check_async_scan()
+    ovModbus.args = next((args for _, args in group if not args.async_scan), group[0][1])
+    client, is_connected = ovModbus.connect()
+    ovModbus.client = client
+    for name, args in group:
+        result = {"device": name, "method": args.method, "slave": args.slave, "output": args.output}
+        if not is_connected:
+            result.update(status="failed", error="not connected", seconds=0.0)
+            results.append(result)
+            continue
+        ovModbus.args = args
+        ovModbus.reset_read_stats()
+        start_time = time.perf_counter()
+        try:
+            ovModbus.run()
+            if ovModbus.read_stats["requests"] and not ovModbus.read_stats["registers"]:
+                result.update(status="failed", error="no register read")
+            else:
+                result["status"] = "ok"
+        except Exception as e:
+            result.update(status="failed", error=f"{e}")
+        result["seconds"] = round(time.perf_counter() - start_time, 3)
+        result.update(requests=ovModbus.read_stats["requests"], errors=ovModbus.read_stats["errors"])
+        results.append(result)
+    if client: client.close()
+    ovModbus.close_async()
+    return results
+
+def init_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inventory', type=str, help='JSON file with the devices (and defaults for all devices)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of connections scanned in parallel')
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help='Directory for the output files and the summary')
+    return parser
+
+def main():
+    args = init_parser().parse_args()
+    inventory = ovModbus.load_json(args.inventory)
+    defaults = inventory.get("defaults", {}) if isinstance(inventory, dict) else {}
+    devices = inventory.get("devices", []) if isinstance(inventory, dict) else inventory
+    devices = [{**defaults, **device} for device in devices]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # the json-files are loaded once and handed to the workers
+    lookup = ovModbus.load_lookup()
+    groups = group_devices(devices, args.output_dir)
+    print(f"Scanning {len(devices)} devices on {len(groups)} connections with {min(args.workers, len(groups))} workers", file=sys.stderr)
+
+    start_time = time.perf_counter()
+    results = []
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), mp_context=context, initializer=init_worker, initargs=(lookup,)) as executor:
+        futures = {executor.submit(scan_group, group): group for group in groups}
+        for future in as_completed(futures):
+            try:
+                results += future.result()
+            except Exception as e:
+                results += [{"device": name, "method": device_args.method, "slave": device_args.slave, "status": "failed", "error": f"{e}", "seconds": 0.0} for name, device_args in futures[future]]
+    elapsed = time.perf_counter() - start_time
+
+    results.sort(key=lambda result: result["device"])
+    print("Device\tMethod\tSlave\tRequests\tErrors\tSeconds\tStatus".expandtabs(16))
+    for result in results:
+        status = result["status"] if result["status"] == "ok" else f"{result['status']}: {result.get('error', '')}"
+        print(f"{result['device']}\t{result['method']}\t{result['slave']}\t{result.get('requests', '')}\t{result.get('errors', '')}\t{result['seconds']}\t{status}".expandtabs(16))
+    failed = sum(1 for result in results if result["status"] != "ok")
+    print(f"Total: {len(results)} devices, {failed} failed, {elapsed:.2f}s")
+    ovModbus.save_output(os.path.join(args.output_dir, SUMMARY_FILE), json.dumps({"seconds": round(elapsed, 3), "failed": failed, "devices": results}, indent=2), True)
+
+if __name__ == "__main__":
+    main()
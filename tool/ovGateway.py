@@ -0,0 +1,273 @@
+#                                                  #
+#      ovGateway.py  Caching Modbus TCP gateway    #
+#                                                  #
+#      Copyright 2023 MiSc                         #
+#                                                  #
+#      This code is licensed under the GPL         #
+#                                                  #
+
+import sys
+import time
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pymodbus.exceptions import ModbusException, ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+import ovModbus
+import ovSimulator
+
+DEFAULT_LISTEN_HOST = '127.0.0.1'
+DEFAULT_LISTEN_PORT = 1502
+DEFAULT_TTL = 30
+STATIC_TTL = 3600
+NEGATIVE_TTL = 300
+
+# Upstream reads are made in pages of the 10-register grid of the parameter blocks
+PAGE_SIZE = ovModbus.PARAMETER_BLOCK_SIZE
+ADDRESS_SPACE = 0x10000
+
+def init_parser():
+    parser = ovModbus.init_parser()
+    parser.add_argument('--listen_host', type=str, default=DEFAULT_LISTEN_HOST, help='Listen address of the gateway')
+    parser.add_argument('--listen_port', type=int, default=DEFAULT_LISTEN_PORT, help='Listen port of the gateway')
+    parser.add_argument('--ttl', type=str, default="", help='Cache time in seconds per address range, e.g. 12288-18417=15,0-299=60')
+    parser.add_argument('--default_ttl', type=float, default=DEFAULT_TTL, help='Cache time in seconds of values without a --ttl range')
+    parser.add_argument('--static_ttl', type=float, default=STATIC_TTL, help='Cache time in seconds of the parameter block metadata (registers 2-9)')
+    parser.add_argument('--negative_ttl', type=float, default=NEGATIVE_TTL, help='Cache time in seconds of addresses answered with an exception')
+    return parser
+
+# TTL ranges "first-last=seconds,..." as [(first, last, seconds)]
+def parse_ttl(text):
+    rules = []
+    for part in filter(None, (part.strip() for part in text.split(","))):
+        addresses, _, seconds = part.partition("=")
+        first, _, last = addresses.partition("-")
+        rules.append((int(first), int(last or first), float(seconds)))
+    return rules
+
+def page_of(address):
+    return address - (address - ovModbus.DEFAULT_START_ADDRESS) % PAGE_SIZE
+
+# Upstream calls, run one after another in the single upstream thread on the client of ovModbus
+
+# Registers of address..address+count-1 and whether the device answered all requests
+def upstream_read(address, count, slave):
+    timeouts = ovModbus.read_stats["timeouts"]
+    results = list(ovModbus.read_registers_coalesced(address, address + count - 1, slave, ovModbus.transport["max_count"]))
+    return results, ovModbus.read_stats["timeouts"] == timeouts
+
+def upstream_poll(address, count, slave):
+    return ovModbus.read_block(address, count, slave)
+
+# Write request of a client passed through to the device, returns the response pdu
+def upstream_write(pdu, slave):
+    function_code = pdu[0]
+    try:
+        if function_code == 6:
+            address, value = struct.unpack('>HH', pdu[1:5])
+            response = ovModbus.client.write_register(address, value, slave)
+        else:
+            address, count = struct.unpack('>HH', pdu[1:5])
+            response = ovModbus.client.write_registers(address, list(struct.unpack(f'>{count}H', pdu[6:6 + 2 * count])), slave)
+    except ModbusException as e:
+        response = None
+    if response is None or isinstance(response, ModbusIOException):
+        return bytes((function_code | 0x80, ovSimulator.EXCEPTION_GATEWAY_NO_RESPONSE))
+    if isinstance(response, ExceptionResponse):
+        return bytes((function_code | 0x80, response.exception_code))
+    return pdu[:5]
+
+# Modbus TCP server with the framing of the simulator, reads are answered from the register cache.
+# Misses are queued as pages and read by one fetcher, pages requested while the device is busy
+# are merged into the next upstream reads. Writes go to the device and invalidate the cache.
+class OvumGateway(ovSimulator.OvumSimulator):
+    def __init__(self, args):
+        super().__init__({}, [args.slave])
+        self.args = args
+        self.ttl_rules = parse_ttl(args.ttl)
+        self.values = {}
+        self.expires = {}
+        self.static = set()
+        self.pending = {}
+        self.queued = set()
+        self.wakeup = None
+        self.poll_reads = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats.update({"hits": 0, "misses": 0, "writes": 0, "polls": 0})
+
+    def ttl(self, address, value):
+        if value is None:
+            return self.args.negative_ttl
+        for first, last, seconds in self.ttl_rules:
+            if first <= address <= last:
+                return seconds
+        if address in self.static:
+            return self.args.static_ttl
+        return self.args.default_ttl
+
+    def store(self, address, value, now):
+        self.values[address] = value
+        self.expires[address] = now + self.ttl(address, value)
+
+    def invalidate(self, address, count):
+        for idx in range(address, address + count):
+            self.values.pop(idx, None)
+            self.expires.pop(idx, None)
+
+    def is_fresh(self, address, count, now):
+        return all(self.expires.get(idx, 0) > now for idx in range(address, address + count))
+
+    # Parameter layout of the device: metadata and values are cached, the values are polled
+    def load_layout(self):
+        parameters = []
+        now = time.monotonic()
+        for address, registers in ovModbus.read_parameter_layout(self.args.start_address, self.args.stop_address, self.args.slave):
+            if registers is None:
+                continue
+            self.static.update(range(address + ovModbus.VALUE_COUNT, address + PAGE_SIZE))
+            for offset, value in enumerate(registers):
+                self.store(address + offset, value, now)
+            parameter = ovModbus.decode_parameter(address, registers)
+            if not parameter.is_menu:
+                parameters.append(parameter)
+        # reading over the metadata in between merges the values of adjacent blocks into one request
+        self.poll_reads = ovModbus.plan_reads([(parameter.address, ovModbus.VALUE_COUNT) for parameter in parameters], max(self.args.max_gap or 0, PAGE_SIZE - ovModbus.VALUE_COUNT))
+        return parameters
+
+    async def upstream(self, function, *arguments):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *arguments)
+
+    # Futures of the pages of address..address+count-1, pages not in flight are queued for the fetcher
+    def request_pages(self, address, count):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for page in range(page_of(address), address + count, PAGE_SIZE):
+            if page not in self.pending:
+                self.pending[page] = loop.create_future()
+                self.queued.add(page)
+            futures.append(self.pending[page])
+        self.wakeup.set()
+        return futures
+
+    async def fetcher(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            pages = sorted(self.queued)
+            self.queued.clear()
+            ranges = [(max(0, page), min(page + PAGE_SIZE, ADDRESS_SPACE) - max(0, page)) for page in pages]
+            for address, count in ovModbus.plan_reads(ranges, 0):
+                error = None
+                try:
+                    results, answered = await self.upstream(upstream_read, address, count, self.args.slave)
+                    now = time.monotonic()
+                    for idx, value in results:
+                        # after lost responses the failing addresses are not cached as invalid
+                        if value is not None or answered:
+                            self.store(idx, value, now)
+                except Exception as e:
+                    # the clients waiting for these pages get an exception response, the fetcher keeps running
+                    print(f"Error: Reading {address}-{address + count - 1} failed: {e}", file=sys.stderr)
+                    error = e
+                for page in [page for page in pages if address <= max(0, page) < address + count]:
+                    future = self.pending.pop(page)
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+
+    async def poller(self):
+        while True:
+            poll_start = time.monotonic()
+            if self.poll_reads:
+                # one request per job, so misses of the clients are read in between
+                for address, count in self.poll_reads:
+                    registers, error = await self.upstream(upstream_poll, address, count, self.args.slave)
+                    now = time.monotonic()
+                    if not error:
+                        for offset, value in enumerate(registers):
+                            self.store(address + offset, value, now)
+                self.stats["polls"] += 1
+            if self.args.metrics:
+                ovModbus.write_metrics(self.args.metrics, ovModbus.format_metrics() + self.format_metrics())
+            await asyncio.sleep(max(0, self.args.interval - (time.monotonic() - poll_start)))
+
+    async def respond(self, pdu, wire_bytes=0):
+        self.stats["requests"] += 1
+        function_code = pdu[0]
+        if function_code == 3 and len(pdu) == 5:
+            address, count = struct.unpack('>HH', pdu[1:5])
+            if not 1 <= count <= ovModbus.MAX_READ_COUNT or address + count > ADDRESS_SPACE:
+                return self.exception(function_code, ovSimulator.EXCEPTION_ILLEGAL_VALUE)
+            if self.is_fresh(address, count, time.monotonic()):
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+                results = await asyncio.gather(*self.request_pages(address, count), return_exceptions=True)
+                if any(isinstance(result, Exception) for result in results):
+                    return self.exception(function_code, ovSimulator.EXCEPTION_GATEWAY_NO_RESPONSE)
+            values = [self.values.get(idx, -1) for idx in range(address, address + count)]
+            if -1 in values:
+                return self.exception(function_code, ovSimulator.EXCEPTION_GATEWAY_NO_RESPONSE)
+            if None in values:
+                return self.exception(function_code, ovSimulator.EXCEPTION_ILLEGAL_ADDRESS)
+            return struct.pack(f'>BB{count}H', function_code, count * 2, *values)
+        if function_code in (6, 16) and len(pdu) >= 5:
+            address, count = struct.unpack('>HH', pdu[1:5])
+            if function_code == 6:
+                count = 1
+            elif len(pdu) < 6 or pdu[5] != 2 * count or len(pdu) != 6 + pdu[5]:
+                return self.exception(function_code, ovSimulator.EXCEPTION_ILLEGAL_VALUE)
+            self.stats["writes"] += 1
+            response = await self.upstream(upstream_write, pdu, self.args.slave)
+            self.invalidate(address, count)
+            return response
+        return self.exception(function_code, ovSimulator.EXCEPTION_ILLEGAL_FUNCTION)
+
+    def format_metrics(self):
+        lines = []
+        for name, key, help in (("requests_total", "requests", "Client requests to the gateway."), ("cache_hits_total", "hits", "Client reads answered from the cache."),
+                                ("cache_misses_total", "misses", "Client reads that waited for the device."), ("writes_total", "writes", "Client writes passed through to the device."),
+                                ("polls_total", "polls", "Scheduled polls of the parameter values.")):
+            lines.append(f"# HELP {ovModbus.METRICS_PREFIX}_gateway_{name} {help}")
+            lines.append(f"# TYPE {ovModbus.METRICS_PREFIX}_gateway_{name} counter")
+            lines.append(f'{ovModbus.METRICS_PREFIX}_gateway_{name}{{slave="{self.args.slave}"}} {self.stats[key]}')
+        return "\n".join(lines) + "\n"
+
+    async def serve(self):
+        self.wakeup = asyncio.Event()
+        started = lambda port: print(f"Modbus TCP gateway: {self.args.listen_host}:{port}", file=sys.stderr)
+        await asyncio.gather(self.fetcher(), self.poller(), self.serve_tcp(self.args.listen_host, self.args.listen_port, started))
+
+def main():
+    args = init_parser().parse_args()
+    args.async_scan = False
+    ovModbus.args = args
+    start_time = time.perf_counter()
+    client, is_connected = ovModbus.connect()
+    if not is_connected:
+        print("Error: Could not connect to the device", file=sys.stderr)
+        sys.exit(1)
+    ovModbus.client = client
+    if args.probe:
+        ovModbus.probe_block_size(args.start_address, args.slave, args.block_size)
+    gateway = OvumGateway(args)
+    parameters = gateway.load_layout()
+    print(f"Caching {len(gateway.values)} registers, polling {len(parameters)} parameters with {len(gateway.poll_reads)} requests every {args.interval:g}s", file=sys.stderr)
+    try:
+        asyncio.run(gateway.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    stats = gateway.stats
+    print(f"Client requests: {stats['requests']} (cache hits: {stats['hits']}, misses: {stats['misses']}, writes: {stats['writes']}), polls: {stats['polls']}", file=sys.stderr)
+    if args.stats:
+        ovModbus.print_stats_summary(time.perf_counter() - start_time)
+    else:
+        ovModbus.print_read_stats()
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,24 @@
 #      This code is licensed under the GPL         #
 #                                                  #
 
+import os
 import json
+import pickle
+import struct
+import hashlib
 import re
+import csv
+import sys
+import time
 import argparse
+import asyncio
+import bisect
+import cProfile
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 import pymodbus.client as modbusClient
-from pymodbus.exceptions import ModbusIOException
+from pymodbus.exceptions import ModbusException, ModbusIOException
+from pymodbus.pdu import ExceptionResponse
 from slugify import slugify
 
 # Define constants
@@ -31,11 +44,55 @@ DEFAULT_START_ADDRESS = 12288
 DEFAULT_STOP_ADDRESS = 18408
 DEFAULT_LANG = 'default'
 
+MAX_READ_COUNT = 125
+MAX_WRITE_COUNT = 123
+MIN_SPLIT_COUNT = 4
+
+DEFAULT_INFLIGHT = 8
+DEFAULT_TIMEOUT = 3
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.1
+ASYNC_WINDOW = 16
+
+MIN_TIMEOUT = 0.05
+MIN_DELAY = 0.01
+MAX_DELAY = 1.0
+PROBE_COUNTS = (125, 100, 64, 50, 32, 20, 10)
+EXCEPTION_ILLEGAL_ADDRESS = 2
+EXCEPTION_BUSY = 6
+EXCEPTION_TEXTS = {1: "illegal function", 2: "illegal data address", 3: "illegal data value", 4: "device failure", 5: "acknowledge", 6: "busy", 10: "gateway path unavailable", 11: "gateway no response"}
+
+DEFAULT_INTERVAL = 15
+# None: the gap follows the measured cost of a request, see value_gap()
+DEFAULT_MAX_GAP = None
+VALUE_COUNT = 2
+
 JSON_UNITS = 'ovUnits.json'
 JSON_DESCRIPTOR = 'ovDescriptor.json'
 JSON_TYPEMAP = 'ovTypeMap.json'
+LOOKUP_CACHE = 'ovLookup.cache'
+LOOKUP_CACHE_VERSION = 1
+LAYOUT_CACHE_DIR = 'ovCache'
+LAYOUT_CACHE_VERSION = 1
+LAYOUT_SAMPLES = 3
+REGION_CACHE_VERSION = 1
 
 HASS_MODBUS_NAME = 'ovum_modbus'
+HASS_INTERVALS = '15,60,300'
+HASS_FAST_CLASSES = ('temperature', 'power')
+HASS_LEGACY_INTERVAL = 15
+
+OUTPUT_FORMATS = ['tsv', 'csv', 'jsonl', 'ndjson']
+OUTPUT_BUFFER = 1 << 16
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRICS_PREFIX = 'ovmodbus'
+
+read_stats = {"requests": 0, "errors": 0, "retries": 0, "timeouts": 0, "registers": 0, "seconds": 0.0, "decode_seconds": 0.0,
+              "latency": [0] * (len(LATENCY_BUCKETS) + 1), "latency_seconds": 0.0, "exceptions": {}, "sizes": {}}
+profiler = None
+async_connection = {"loop": None, "client": None}
+transport = {"srtt": None, "rttvar": 0.0, "timeout": None, "delay": 0.0, "max_count": MAX_READ_COUNT, "exception": None, "cost": [0, 0, 0.0, 0, 0.0]}
 
 # Create YAML for Home Assistant with all sensors based on modbus
 def get_hass_modbustcp_def(data):
@@ -68,7 +125,7 @@ def get_hass_sensor_def(data):
         - name: "{data['description']}"         
           unique_id: ovum_{data['parameter']}_sensor{data['address']}
           address: {data['address']}
-          scan_interval: 15                
+          scan_interval: {data['scan_interval']}                
           data_type: int32
           scale: {data['scale']}
           precision: {data['precision']}
@@ -95,6 +152,33 @@ def get_hass_templatesensor_def(data):
                 {{{{ mapper[state] if state in mapper}}}}"""
     return f"{sensor_string}"
 
+def get_hass_groupsensor_def(data):
+    sensor_string = f"""
+        - name: "{data['name']}"
+          unique_id: {data['unique_id']}
+          address: {data['address']}
+          scan_interval: {data['scan_interval']}
+          data_type: int32
+          virtual_count: {data['virtual_count']}
+          scale: 1
+          precision: 0
+          swap: word
+          input_type: holding
+          slave: {data['slave']}"""
+    return f"{sensor_string}"
+
+def get_hass_valuetemplate_def(data):
+    state = f"states('sensor.{data['group_sensor']}')|int" if int(data['precision']) == 0 else f"(states('sensor.{data['group_sensor']}')|float * {data['scale']})|round({data['precision']})"
+    sensor_string = f"""
+        - sensor:
+            - name: "{data['description']}"
+              unique_id: ovum_{data['parameter']}_sensor{data['address']}
+              unit_of_measurement: "{data['unit']}"
+              availability: "{{{{ has_value('sensor.{data['group_sensor']}') }}}}"
+              state: "{{{{ {state} }}}}"
+              {data['device_class']}"""
+    return f"{sensor_string}"
+
 # Load JSON
 def load_json(filename):
     try:
@@ -104,6 +188,64 @@ def load_json(filename):
         print(f'Error: {filename} file not found')
         return {}
 
+# Build indexed lookup tables: descriptor id, multi id and unit id
+def build_lookup(descriptor, units, typeMap):
+    descriptors = {}
+    for item in descriptor:
+        descriptors.setdefault(item['iddescriptor'], item.get("tlangalphakey", {}))
+    multis = {}
+    for item in typeMap:
+        for key, entry in item.items():
+            if int(key) in multis: continue
+            tvalues = [(tvalue["in_INPUT"], tvalue["alphakey"]) for tvalue in entry["tvalues"]]
+            values = {}
+            for in_input, alphakey in tvalues: values.setdefault(in_input, alphakey)
+            multis[int(key)] = {"tvalues": tvalues, "values": values}
+    return {"descriptors": descriptors, "multis": multis, "units": {int(key): unit for key, unit in units.items()}}
+
+def lookup_sources():
+    sources = []
+    for filename in (JSON_DESCRIPTOR, JSON_UNITS, JSON_TYPEMAP):
+        try:
+            stat = os.stat(filename)
+            sources.append((filename, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            sources.append((filename, None, None))
+    return sources
+
+# Load lookup tables from the cache next to the json-files, rebuild if the json-files changed
+def load_lookup():
+    cache_file = os.path.join(os.path.dirname(JSON_DESCRIPTOR), LOOKUP_CACHE)
+    sources = lookup_sources()
+    try:
+        with open(cache_file, "rb") as file:
+            cache = pickle.load(file)
+        if cache.get("version") == LOOKUP_CACHE_VERSION and cache.get("sources") == sources:
+            return cache["lookup"]
+    except Exception:
+        pass
+    lookup = build_lookup(load_json(JSON_DESCRIPTOR), load_json(JSON_UNITS), load_json(JSON_TYPEMAP))
+    if all(mtime is not None for _, mtime, _ in sources):
+        try:
+            with open(cache_file, "wb") as file:
+                pickle.dump({"version": LOOKUP_CACHE_VERSION, "sources": sources, "lookup": lookup}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+    return lookup
+
+def get_descriptor_text(descriptor_id, lang):
+    return lookup["descriptors"].get(int(descriptor_id), {}).get(lang, "")
+
+def get_enum(multi_id):
+    return lookup["multis"].get(int(multi_id))
+
+def get_enum_text(multi_id, value, lang):
+    alphakey = lookup["multis"].get(int(multi_id), {}).get("values", {}).get(value)
+    return alphakey.get(lang) if alphakey else ""
+
+def get_unit(unit_id):
+    return lookup["units"].get(int(unit_id), {})
+
 def save_output(filename, content, init=False):
     try:
         mode = "w" if init else "a"
@@ -114,11 +256,63 @@ def save_output(filename, content, init=False):
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
+# Output opened once per run, rows are written as they are decoded.
+# tsv/csv: text rows, jsonl: one object per row, ndjson: a schema line followed by one object per row
+class OutputSink:
+    def __init__(self, filename=None, format='tsv'):
+        self.format = format
+        self.titles = []
+        self.tab_size = 0
+        self.file = sys.stdout
+        if filename != None:
+            try:
+                self.file = open(filename, "w", encoding='UTF-8', buffering=OUTPUT_BUFFER)
+            except PermissionError:
+                print(f"Error: You do not have permission to write to '{filename}'.")
+                raise SystemExit(1)
+
+    def is_json(self):
+        return self.format in ('jsonl', 'ndjson')
+
+    def write(self, text):
+        self.file.write(text)
+
+    def header(self, titles, types, tab_size=0):
+        self.titles = titles
+        self.tab_size = tab_size
+        if self.format == 'ndjson':
+            self.write(json.dumps({"schema": {"fields": [{"name": title, "type": type} for title, type in zip(titles, types)]}}) + "\n")
+        elif not self.is_json():
+            self.write_text(titles)
+
+    def write_text(self, values):
+        line = (';' if self.format == 'csv' else '\t').join([f"{value}" for value in values])
+        self.write(f"{line.expandtabs(self.tab_size) if self.tab_size else line}\n")
+
+    # Empty fields ("") are null in json
+    def row(self, values):
+        if self.is_json():
+            self.write(json.dumps({title: None if value == "" else value for title, value in zip(self.titles, values)}, ensure_ascii=False) + "\n")
+        else:
+            self.write_text(values)
+
+    def error_row(self, address):
+        if self.is_json():
+            self.write(json.dumps({"AddrDec": address, "error": True}) + "\n")
+        else:
+            self.write_text([address] + ["#err"] * (len(self.titles) - 1))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
 def generate_output(output):
-    if args.output != None:
-        save_output(args.output, f"{output}\n")
-    else:
-        print(output)
+    output_sink.write(f"{output}\n")
 
 # Initial Setup, call-arguments, load json-files
 def init_parser():
@@ -135,17 +329,43 @@ def init_parser():
     parser.add_argument('--start_address', type=int, default=DEFAULT_START_ADDRESS, help='Start address of the register')
     parser.add_argument('--stop_address', type=int, default=DEFAULT_STOP_ADDRESS, help='Stop address of the register')
     parser.add_argument('--dump', action='store_true', help='Loop through addresses and dump content')
+    parser.add_argument('--discover', action='store_true', help='Find the live register regions with large probe reads and save the region map for --dump --cache')
+    parser.add_argument('--discover_all', action='store_true', help='With --discover, read failing blocks register by register: finds every live register, about one request per register')
+    parser.add_argument('--block_size', type=int, default=MAX_READ_COUNT, help=f'Maximum registers per request (1-{MAX_READ_COUNT})')
+    parser.add_argument('--async_scan', action='store_true', help='Modbus TCP only: keep several requests in flight')
+    parser.add_argument('--inflight', type=int, default=DEFAULT_INFLIGHT, help='Requests in flight for --async_scan')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Maximum timeout per request in seconds, the timeout adapts to the measured round trip time')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help='Retries per request on lost responses and busy devices')
+    parser.add_argument('--backoff', type=float, default=DEFAULT_BACKOFF, help='Delay in seconds before the first retry, doubled for every further retry')
+    parser.add_argument('--no_probe', dest='probe', action='store_false', help='Do not probe the largest read the device answers at start_address')
+    parser.add_argument('--monitor', action='store_true', help='Discover the parameters once, then poll and print changed values')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='Seconds between polls for --monitor')
+    parser.add_argument('--polls', type=int, default=0, help='Number of polls for --monitor (0 = endless)')
+    parser.add_argument('--store', type=str, default=None, help='Append every poll of --monitor to the time series store in this directory (see ovStore.py)')
+    parser.add_argument('--max_gap', type=int, default=DEFAULT_MAX_GAP, help='Read over gaps of up to n registers to merge value reads for --monitor (default: as many registers as cost one request, at most the 8 metadata registers of a block)')
+    parser.add_argument('--write', type=str, default=None, help='Write the parameter values of a CSV or YAML profile (code or address and value) and verify them')
+    parser.add_argument('--dry_run', action='store_true', help='Validate the profile of --write and show the changes without writing')
+    parser.add_argument('--json', action='store_true', help='Output as JSON lines, same as --format jsonl')
+    parser.add_argument('--cache', action='store_true', help='Use the cached parameter layout instead of a full scan, --dump reads only the regions found by --discover')
+    parser.add_argument('--rescan', action='store_true', help='Force a full scan and update the cached parameter layout')
+    parser.add_argument('--cache_dir', type=str, default=LAYOUT_CACHE_DIR, help='Directory of the parameter layout cache and the region map')
     parser.add_argument('--csv', action='store_true', help='Output is in CSV-Format')
+    parser.add_argument('--format', type=str, choices=OUTPUT_FORMATS, default=None, help='Output format: tsv (default), csv, jsonl or ndjson (json lines with a schema line)')
     parser.add_argument('--hass', action='store_true', help='Create Home Assistant YAML for sensors')
+    parser.add_argument('--hass_group', action='store_true', help='Read adjacent value registers of --hass sensors with one request (virtual_count)')
+    parser.add_argument('--hass_intervals', type=str, default=HASS_INTERVALS, help='Scan intervals of --hass sensors: fast (temperature, power), normal, slow (writable parameters)')
     parser.add_argument('--min', action='store_true', help='Create minimal output')
     parser.add_argument('--noerror', action='store_true', help='Skip addresses with error and do not print')
     parser.add_argument('--output', type=str, default=None, help='Write output to a file')
+    parser.add_argument('--stats', action='store_true', help='Print a summary of requests, latencies, exceptions and time spent to stderr')
+    parser.add_argument('--metrics', type=str, default=None, help='Write metrics in the Prometheus text format to a file, after every poll for --monitor')
+    parser.add_argument('--profile', type=str, default=None, help='Profile decoding and formatting with cProfile and write the stats to a file')
     parser.add_argument('--dev', action='store_true', help='Debugging and test parameter')
     return parser
 
 # Connect to Modbus TCP
-def connect_to_modbusTCP(host, port):
-    client = modbusClient.ModbusTcpClient(host=host, port=port)
+def connect_to_modbusTCP(host, port, timeout=DEFAULT_TIMEOUT):
+    client = modbusClient.ModbusTcpClient(host=host, port=port, timeout=timeout, retries=0)
     try:
         client.connect()
         return client, client.is_socket_open()
@@ -155,8 +375,8 @@ def connect_to_modbusTCP(host, port):
         return None, False
 
 # Connect to Modbus RTU
-def connect_to_modbusRTU(comport, baudrate, parity, stopbits):
-    client = modbusClient.ModbusSerialClient(port=comport, baudrate=baudrate, parity=parity, stopbits=stopbits)
+def connect_to_modbusRTU(comport, baudrate, parity, stopbits, timeout=DEFAULT_TIMEOUT):
+    client = modbusClient.ModbusSerialClient(port=comport, baudrate=baudrate, parity=parity, stopbits=stopbits, timeout=timeout, retries=0)
     try:
         client.connect()
         return client, client.is_socket_open()
@@ -165,221 +385,1165 @@ def connect_to_modbusRTU(comport, baudrate, parity, stopbits):
         print("Error:", e)
         return None, False
 
-# Add Space after (n) characters
-def format_space(input_string, n):
-    result = ' '.join([input_string[i:i + n] for i in range(0, len(input_string), n)])
-    return result.strip()
+def to_int16(value):
+    return value - 0x10000 if value & 0x8000 else value
 
-def read_register(address, count, slave):
-    response = []
-    try:
-        register_content = client.read_holding_registers(address, count, slave)
-        if register_content.isError():
-            return response, True
+# Two ASCII characters of a register, empty if one of the bytes is not printable
+def register_chars(value):
+    byte1 = value >> 8
+    byte2 = value & 0xFF
+    return f"{chr(byte1)}{chr(byte2)}" if (31 < byte1 < 127) and (31 < byte2 < 127) else ""
+
+# Decoded Ovum parameter block (10 registers):
+# 0-1 value (Int32, low word first), 2 min (Int16), 3 max (UInt16), 4 precision (bits 12-15) and unit (bits 0-6),
+# 5 flags (bit 15 menu, bit 14 writable), 6-7 parameter code (4 chars), 8 descriptor id, 9 multi id
+class OvumParameter:
+    __slots__ = ("address", "value", "min_raw", "max_raw", "precision", "unit_id", "is_menu", "is_readonly", "code", "descriptor_id", "multi_id")
+
+    def __init__(self, address, value, min_raw, max_raw, format_word, flags, code1, code2, descriptor_id, multi_id):
+        self.address = address
+        self.value = value
+        self.min_raw = min_raw
+        self.max_raw = max_raw
+        self.precision = format_word >> 12
+        self.unit_id = format_word & 0x7F
+        self.is_menu = bool(flags & 0x8000)
+        self.is_readonly = not (flags & 0x4000)
+        self.code = register_chars(code1) + register_chars(code2)
+        self.descriptor_id = descriptor_id
+        self.multi_id = multi_id
+
+    def scale(self, raw):
+        return round(raw * 10 ** (-self.precision), self.precision)
+
+    # Min/Max as shown in the dump, the limits -32768/0 and 32767/65535 are not scaled
+    def min_value(self):
+        return self.scale(self.min_raw) if self.min_raw not in (-0x8000, 0) else self.min_raw
+
+    def max_value(self):
+        return self.scale(self.max_raw) if self.max_raw not in (0x7FFF, 0xFFFF) else self.max_raw
+
+PARAMETER_BLOCK_SIZE = 10
+PARAMETER_STRUCT = struct.Struct('<ihH6H')
+
+# Decode one or more consecutive parameter blocks of raw registers
+def decode_parameters(address, registers):
+    data = struct.pack(f'<{len(registers)}H', *registers)
+    for i, fields in enumerate(PARAMETER_STRUCT.iter_unpack(data)):
+        yield OvumParameter(address + i * PARAMETER_BLOCK_SIZE, *fields)
+
+def decode_parameter(address, registers):
+    return OvumParameter(address, *PARAMETER_STRUCT.unpack(struct.pack(f'<{PARAMETER_BLOCK_SIZE}H', *registers)))
+
+# Smoothed round trip time and the timeout derived from it (RFC 6298), the pause between
+# requests is halved after every answer and dropped once it is shorter than a round trip
+def update_transport(rtt):
+    if transport["srtt"] is None:
+        transport["srtt"] = rtt
+        transport["rttvar"] = rtt / 2
+    else:
+        transport["rttvar"] = 0.75 * transport["rttvar"] + 0.25 * abs(transport["srtt"] - rtt)
+        transport["srtt"] = 0.875 * transport["srtt"] + 0.125 * rtt
+    transport["timeout"] = max(MIN_TIMEOUT, transport["srtt"] + 4 * transport["rttvar"])
+    transport["delay"] = transport["delay"] / 2 if transport["delay"] > max(MIN_DELAY, transport["srtt"]) else 0.0
+
+# After a lost response pause one round trip plus the serial frame of the largest read,
+# so a late response has left the line before the next request; doubled for every further loss
+def transport_lost():
+    pause = max(MIN_DELAY, (transport["srtt"] or 0.0) + frame_time(transport["max_count"]))
+    transport["delay"] = min(MAX_DELAY, max(pause, transport["delay"] * 2))
+
+# Time on a serial line for request and response of count registers (11 bits per byte),
+# kept out of the round trip time so small and large reads share one timeout
+def frame_time(count):
+    if args.method != METHOD_RTU:
+        return 0.0
+    return (8 + 5 + 2 * count) * 11 / args.baudrate
+
+# Timeout of a request, doubled for every retry up to --timeout
+def request_timeout(attempt, count):
+    if transport["timeout"] is None:
+        return args.timeout
+    return min(args.timeout, (transport["timeout"] + frame_time(count)) * 2 ** attempt)
+
+# Exponential backoff before a retry
+def backoff_delay(attempt):
+    return args.backoff * 2 ** (attempt - 1) + transport["delay"]
+
+def set_client_timeout(timeout):
+    client.comm_params.timeout_connect = timeout
+    if args.method == METHOD_RTU and client.socket:
+        client.socket.timeout = timeout
+
+# Count a request in the stats: latency histogram, registers per request, lost responses and exception codes
+def record_request(elapsed, count, response):
+    read_stats["requests"] += 1
+    read_stats["latency"][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+    read_stats["latency_seconds"] += elapsed
+    read_stats["sizes"][count] = read_stats["sizes"].get(count, 0) + 1
+    if response is None or isinstance(response, ModbusIOException):
+        read_stats["timeouts"] += 1
+    elif isinstance(response, ExceptionResponse):
+        read_stats["exceptions"][response.exception_code] = read_stats["exceptions"].get(response.exception_code, 0) + 1
+    else:
+        cost = transport["cost"]
+        cost[0] += 1
+        cost[1] += count
+        cost[2] += elapsed
+        cost[3] += count * count
+        cost[4] += count * elapsed
+
+# Gap of value reads without --max_gap: the registers that take as long as one more request. Time per request
+# and per register are fitted to the answered requests (on RTU the line time is part of both), the gap is
+# at most the metadata of one block, so a value read never spans a block without polled values.
+def value_gap():
+    max_gap = PARAMETER_BLOCK_SIZE - VALUE_COUNT
+    n, counts, seconds, squares, products = transport["cost"]
+    spread = n * squares - counts * counts
+    if spread <= 0:
+        return max_gap
+    per_register = (n * products - counts * seconds) / spread
+    per_request = (seconds - per_register * counts) / n
+    if per_register <= 0:
+        return max_gap
+    return max(0, min(max_gap, int(per_request / per_register)))
+
+# Read raw registers with one request, count requests and time spent on the bus.
+# Lost responses and busy devices are retried with backoff, a TCP connection is reopened after a lost response.
+def read_block(address, count, slave, retries=None):
+    for attempt in range((args.retries if retries is None else retries) + 1):
+        if attempt:
+            read_stats["retries"] += 1
+            time.sleep(backoff_delay(attempt))
+        elif transport["delay"]:
+            time.sleep(transport["delay"])
+        set_client_timeout(request_timeout(attempt, count))
+        start_time = time.perf_counter()
+        try:
+            register_content = client.read_holding_registers(address, count, slave)
+        except ModbusException as e:
+            register_content = None
+        elapsed = time.perf_counter() - start_time
+        read_stats["seconds"] += elapsed
+        record_request(elapsed, count, register_content)
+        if register_content is None or isinstance(register_content, ModbusIOException):
+            read_stats["errors"] += 1
+            transport["exception"] = None
+            transport_lost()
+            if args.method == METHOD_TCP:
+                client.close()
+            continue
+        update_transport(elapsed - frame_time(count))
+        transport["exception"] = register_content.exception_code if isinstance(register_content, ExceptionResponse) else None
+        if isinstance(register_content, ExceptionResponse) and register_content.exception_code == EXCEPTION_BUSY:
+            read_stats["errors"] += 1
+            continue
+        if register_content.isError() or len(register_content.registers) < count:
+            read_stats["errors"] += 1
+            return [], True
+        read_stats["registers"] += count
+        return register_content.registers[:count], False
+    return [], True
+
+# Read a chunk, split it on errors until the failing addresses are isolated.
+# Splits are aligned to unit registers, a failing unit is not split further. A read of several units is
+# only made with credit: a successful read earns one per unit saved, a failing read costs one, so a chunk
+# takes at most the credit it was given more requests than reading it unit by unit.
+def read_split(address, count, slave, unit, credit):
+    units = -(-count // unit)
+    if units > 1 and credit["units"] < 1:
+        for offset in range(0, count, unit):
+            yield from read_split(address + offset, min(unit, count - offset), slave, unit, credit)
+        return
+    registers, error = read_block(address, count, slave)
+    if not error:
+        credit["units"] += units - 1
+        for i, value in enumerate(registers):
+            yield address + i, value
+    elif units == 1:
+        for i in range(count):
+            yield address + i, None
+    else:
+        credit["units"] -= 1
+        if units <= MIN_SPLIT_COUNT:
+            parts = [(address + offset, min(unit, count - offset)) for offset in range(0, count, unit)]
         else:
-            for i in range(0, len(register_content.registers)):
-                hex = format(register_content.registers[i], '04X')
-                dec_unsigned = int(hex, 16)
-                if dec_unsigned & 0x8000:
-                    dec_signed = -((dec_unsigned^0xFFFF)+1)
-                else:
-                    dec_signed = dec_unsigned
-                byte1 = int(hex[:2], 16)
-                byte2 = int(hex[-2:], 16)
-                char1 = chr(byte1) if (31 < byte1 < 127) and (31 < byte2 < 127) else ""
-                char2 = chr(byte2) if (31 < byte1 < 127) and (31 < byte2 < 127) else ""
-                bin = format(register_content.registers[i], '016b')
-                address_dec = address+i
-                data = {"address_hex": f"{address_dec:#0{6}x}", "address": f"{address +i}", "hex": f"{hex}", "byte1": f"{byte1}", "byte2": f"{byte2}", "UInt16": f"{dec_unsigned}", "Int16": f"{dec_signed}", "char1": f"{char1}", "char2": f"{char2}", "bin": f"{bin}"}
-                response.append(data)
-            return response, False
-    except ModbusIOException as e:
-        return response, True
-
-def generateRegisterDump(start_address, stop_address, slave, separator, noerror):
-    header_titles = ["Idx", "AddrHex", "AddrDec", "Hex", "Byte_1", "Byte_2", "UInt16", "Int16", "Chr", "Bin"]
-    read_count = 1
-    idx = start_address
-    generate_output(separator.join(header_titles))
-    while idx <= stop_address:
-        response, error = read_register(idx, read_count, slave)
+            half = units // 2 * unit
+            parts = [(address, half), (address + half, count - half)]
+        for part_address, part_count in parts:
+            yield from read_split(part_address, part_count, slave, unit, credit)
+
+# Read start_address..stop_address in blocks, yields (address, value) with value None on error.
+# The block size is limited by the probed maximum of the device and rounded down to whole units.
+def read_registers_coalesced(start_address, stop_address, slave, block_size=MAX_READ_COUNT, unit=1):
+    block_size = max(unit, min(block_size, transport["max_count"]) // unit * unit)
+    if args.async_scan:
+        chunks = [(address, min(block_size, stop_address - address + 1)) for address in range(start_address, stop_address + 1, block_size)]
+        for address, count, registers in read_chunks_async(chunks, slave, unit):
+            for i in range(count):
+                yield address + i, None if registers is None else registers[i]
+        return
+    # every chunk adds the credit for one speculative read to what the successful reads saved
+    credit = {"units": 0}
+    address = start_address
+    while address <= stop_address:
+        count = min(block_size, stop_address - address + 1)
+        credit["units"] += 1
+        yield from read_split(address, count, slave, unit, credit)
+        address += count
+
+# Read one block on the async client, retry on timeouts, lost connections and busy devices with backoff
+async def read_block_async(async_client, semaphore, connect_lock, address, count, slave, retries):
+    async with semaphore:
+        for attempt in range(retries + 1):
+            if attempt:
+                read_stats["retries"] += 1
+                await asyncio.sleep(backoff_delay(attempt))
+            async_client.comm_params.timeout_connect = request_timeout(attempt, count)
+            start_time = time.perf_counter()
+            try:
+                async with connect_lock:
+                    if not async_client.connected:
+                        await async_client.connect()
+                register_content = await async_client.read_holding_registers(address, count, slave)
+            except (ModbusException, asyncio.TimeoutError) as e:
+                register_content = None
+            elapsed = time.perf_counter() - start_time
+            record_request(elapsed, count, register_content)
+            if register_content is None:
+                read_stats["errors"] += 1
+                transport["exception"] = None
+                transport_lost()
+                continue
+            update_transport(elapsed)
+            transport["exception"] = register_content.exception_code if isinstance(register_content, ExceptionResponse) else None
+            if isinstance(register_content, ExceptionResponse) and register_content.exception_code == EXCEPTION_BUSY:
+                read_stats["errors"] += 1
+                continue
+            if register_content.isError() or len(register_content.registers) < count:
+                read_stats["errors"] += 1
+                return [], True
+            read_stats["registers"] += count
+            return register_content.registers[:count], False
+    return [], True
+
+# Async counterpart of read_split, returns [(address, count, registers)] with registers None on error.
+# The credit is taken before the request, so parts read concurrently cannot overdraw it.
+async def read_split_async(async_client, semaphore, connect_lock, address, count, slave, retries, unit, credit):
+    units = -(-count // unit)
+    if units > 1 and credit["units"] < 1:
+        parts = [(address + offset, min(unit, count - offset)) for offset in range(0, count, unit)]
+    else:
+        if units > 1:
+            credit["units"] -= 1
+        registers, error = await read_block_async(async_client, semaphore, connect_lock, address, count, slave, retries)
         if not error:
-            data = [f"{idx-start_address}", f"{response[0]['address_hex']}", f"{response[0]['address']}", f"{format_space(response[0]['hex'],2)}", f"{response[0]['byte1']}", f"{response[0]['byte2']}", f"{response[0]['UInt16']}", f"{response[0]['Int16']}", f"{response[0]['char1']}{response[0]['char2']}",f"{format_space(response[0]['bin'],4)}"]
+            if units > 1:
+                credit["units"] += units
+            return [(address, count, registers)]
+        if units == 1:
+            return [(address, count, None)]
+        if units <= MIN_SPLIT_COUNT:
+            parts = [(address + offset, min(unit, count - offset)) for offset in range(0, count, unit)]
+        else:
+            half = units // 2 * unit
+            parts = [(address, half), (address + half, count - half)]
+    results = await asyncio.gather(*[read_split_async(async_client, semaphore, connect_lock, part_address, part_count, slave, retries, unit, credit) for part_address, part_count in parts])
+    return [item for result in results for item in result]
+
+# Every chunk gets the credit for one speculative read, the chunks are read concurrently
+async def gather_chunks_async(async_client, semaphore, connect_lock, chunks, slave, unit):
+    results = await asyncio.gather(*[read_split_async(async_client, semaphore, connect_lock, address, count, slave, args.retries, unit, {"units": 1}) for address, count in chunks])
+    return [item for result in results for item in result]
+
+# Read all chunks [(address, count)] with several requests in flight, yields results in address order.
+# Chunks are gathered in windows so the memory stays constant for large scans.
+def read_chunks_async(chunks, slave, unit):
+    if async_connection["client"] is None:
+        connect_async()
+    loop = async_connection["loop"]
+    semaphore = asyncio.Semaphore(max(1, args.inflight))
+    connect_lock = asyncio.Lock()
+    window = max(1, args.inflight) * ASYNC_WINDOW
+    for i in range(0, len(chunks), window):
+        start_time = time.perf_counter()
+        results = loop.run_until_complete(gather_chunks_async(async_connection["client"], semaphore, connect_lock, chunks[i:i + window], slave, unit))
+        read_stats["seconds"] += time.perf_counter() - start_time
+        yield from results
+
+# Open the client of --async_scan on its own event loop, it is kept for all reads of the run like the sync client
+def connect_async():
+    loop = asyncio.new_event_loop()
+    async_client = modbusClient.AsyncModbusTcpClient(host=args.host, port=args.port, timeout=args.timeout, retries=0)
+    async_connection.update(loop=loop, client=async_client)
+    return bool(loop.run_until_complete(async_client.connect()))
+
+def close_async():
+    if async_connection["client"] is not None:
+        async_connection["client"].close()
+        async_connection["loop"].close()
+        async_connection.update(loop=None, client=None)
+
+# Find the largest read the device answers at address: a request that is too large is
+# rejected with exception 3 or not answered at all. An invalid address keeps the maximum.
+def probe_block_size(address, slave, block_size):
+    transport["max_count"] = max(1, min(block_size, MAX_READ_COUNT))
+    for count in [count for count in PROBE_COUNTS if count <= block_size] or [block_size]:
+        if args.async_scan:
+            error = list(read_chunks_async([(address, count)], slave, count))[0][2] is None
         else:
-            data = [f"{idx}"]
-            for _ in range(1, len(header_titles)): data.append("#err")
-        if not (error and noerror):
-          generate_output(separator.join(data))
-        idx += read_count
-
-def generateOvumDump(start_address, stop_address, slave, separator, lang, min, noerror):
-    header_titles = ["AddrHex", "AddrDec", "Param", "Int32", "Prec", "Value", "Unit", "UnitID", "MultiID", "MinVal", "MaxVal", "ReadOnly", "isMenu", "DescID", "Desc"]
-    header_titles_min = ["Param", "Value", "Unit", "Desc"]
-    tab_size = 16
-    read_count = 10
-    idx = start_address
+            _, error = read_block(address, count, slave, 0)
+        if not error:
+            transport["max_count"] = count
+            break
+        if transport["exception"] == EXCEPTION_ILLEGAL_ADDRESS:
+            return
+    else:
+        transport["max_count"] = PARAMETER_BLOCK_SIZE
+    print(f"Block size: {transport['max_count']} registers per request", file=sys.stderr)
+
+def reset_read_stats():
+    read_stats.update({"requests": 0, "errors": 0, "retries": 0, "timeouts": 0, "registers": 0, "seconds": 0.0, "decode_seconds": 0.0,
+                       "latency": [0] * (len(LATENCY_BUCKETS) + 1), "latency_seconds": 0.0, "exceptions": {}, "sizes": {}})
+
+def print_read_stats():
+    requests = read_stats["requests"]
+    seconds = read_stats["seconds"]
+    average = seconds / requests * 1000 if requests else 0
+    print(f"Requests: {requests} (errors: {read_stats['errors']}, retries: {read_stats['retries']}), registers: {read_stats['registers']}, time: {seconds:.2f}s ({average:.1f} ms/request)", file=sys.stderr)
+
+# Upper bound of the latency bucket that contains the quantile q
+def latency_quantile(q):
+    total = sum(read_stats["latency"])
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), read_stats["latency"]):
+        seen += count
+        if total and seen >= q * total:
+            return bound
+    return 0.0
+
+# Summary of --stats: where the time of the run went, latencies, registers per request and exceptions
+def print_stats_summary(wall_seconds):
+    print_read_stats()
+    io_seconds = read_stats["seconds"]
+    decode_seconds = read_stats["decode_seconds"]
+    print(f"Time: {wall_seconds:.2f}s, I/O {io_seconds:.2f}s, decode/format {decode_seconds:.2f}s, other {max(0.0, wall_seconds - io_seconds - decode_seconds):.2f}s", file=sys.stderr)
+    if read_stats["requests"]:
+        quantiles = ", ".join(f"p{round(q * 100)} <= {latency_quantile(q) * 1000:.0f} ms" for q in (0.5, 0.9, 0.99))
+        print(f"Latency: average {read_stats['latency_seconds'] / read_stats['requests'] * 1000:.1f} ms, {quantiles}", file=sys.stderr)
+        lower = 0.0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), read_stats["latency"]):
+            if count:
+                print(f"  {lower * 1000:>6.0f} - {bound * 1000:>6.0f} ms\t{count}".expandtabs(24), file=sys.stderr)
+            lower = bound
+    sizes = ", ".join(f"{count} x {requests}" for count, requests in sorted(read_stats["sizes"].items(), reverse=True))
+    print(f"Registers per request: {sizes or '-'}", file=sys.stderr)
+    exceptions = ", ".join(f"{code} ({EXCEPTION_TEXTS.get(code, 'unknown')}) x {count}" for code, count in sorted(read_stats["exceptions"].items()))
+    print(f"Lost responses: {read_stats['timeouts']}, exceptions: {exceptions or '-'}", file=sys.stderr)
+
+# read_stats and the transport state in the Prometheus text format
+def format_metrics():
+    endpoint = f"{args.host}:{args.port}" if args.method == METHOD_TCP else f"{args.comport}"
+    labels = f'endpoint="{endpoint}",slave="{args.slave}"'
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {help}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+        for suffix, extra, value in samples:
+            lines.append(f"{METRICS_PREFIX}_{name}{suffix}{{{labels}{extra}}} {value}")
+    metric("requests_total", "counter", "Modbus requests sent.", [("", "", read_stats["requests"])])
+    metric("request_errors_total", "counter", "Requests answered with an error or not answered.", [("", "", read_stats["errors"])])
+    metric("retries_total", "counter", "Requests repeated after a lost response or a busy device.", [("", "", read_stats["retries"])])
+    metric("lost_responses_total", "counter", "Requests without a response.", [("", "", read_stats["timeouts"])])
+    metric("exceptions_total", "counter", "Modbus exception responses by exception code.", [("", f',code="{code}"', count) for code, count in sorted(read_stats["exceptions"].items())])
+    metric("registers_total", "counter", "Registers read successfully.", [("", "", read_stats["registers"])])
+    buckets = []
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), read_stats["latency"]):
+        seen += count
+        buckets.append(("_bucket", f',le="{"+Inf" if bound == float("inf") else bound}"', seen))
+    metric("request_duration_seconds", "histogram", "Round trip time of the requests.", buckets + [("_sum", "", f"{read_stats['latency_seconds']:.6f}"), ("_count", "", read_stats["requests"])])
+    metric("io_seconds_total", "counter", "Time spent waiting for the bus.", [("", "", f"{read_stats['seconds']:.6f}")])
+    metric("decode_seconds_total", "counter", "Time spent decoding and formatting.", [("", "", f"{read_stats['decode_seconds']:.6f}")])
+    metric("block_size", "gauge", "Largest read of the device in registers.", [("", "", transport["max_count"])])
+    metric("rtt_seconds", "gauge", "Smoothed round trip time.", [("", "", f"{transport['srtt'] or 0.0:.6f}")])
+    return "\n".join(lines) + "\n"
+
+# Write the metrics atomically, e.g. for the textfile collector of the Prometheus node exporter
+def write_metrics(filename, text=None):
+    try:
+        with open(f"{filename}.tmp", "w", encoding='UTF-8') as file:
+            file.write(text or format_metrics())
+        os.replace(f"{filename}.tmp", filename)
+    except OSError as e:
+        print(f"Error: Could not write metrics '{filename}': {e}", file=sys.stderr)
+
+# Yields the items of blocks; the work of the consumer between two items (decoding and formatting)
+# is timed as decode_seconds and profiled with --profile, reading the next item is not
+def decode_stage(blocks):
+    for item in blocks:
+        if profiler: profiler.enable()
+        start_time = time.perf_counter()
+        try:
+            yield item
+        finally:
+            read_stats["decode_seconds"] += time.perf_counter() - start_time
+            if profiler: profiler.disable()
+
+REGISTER_TITLES = ["Idx", "AddrHex", "AddrDec", "Hex", "Byte_1", "Byte_2", "UInt16", "Int16", "Chr", "Bin"]
+REGISTER_TYPES = ["integer", "string", "integer", "string", "integer", "integer", "integer", "integer", "string", "string"]
+
+def format_register_row(idx, address, value):
+    bin = f"{value:016b}"
+    return [idx, f"{address:#06x}", address, f"{value >> 8:02X} {value & 0xFF:02X}", value >> 8, value & 0xFF, value, to_int16(value), register_chars(value), f"{bin[:4]} {bin[4:8]} {bin[8:12]} {bin[12:]}"]
+
+# Registers of the region map of --discover (with --cache), addresses outside the live regions are not read
+def read_registers_regions(start_address, stop_address, slave, block_size, ranges):
+    address = start_address
+    for region_address, count in ranges:
+        for idx in range(address, region_address):
+            yield idx, None
+        yield from read_registers_coalesced(region_address, region_address + count - 1, slave, block_size)
+        address = region_address + count
+    for idx in range(address, stop_address + 1):
+        yield idx, None
+
+def generateRegisterDump(start_address, stop_address, slave, noerror, block_size=MAX_READ_COUNT):
+    ranges = region_ranges(start_address, stop_address, slave) if args.cache else None
+    if ranges is None:
+        registers = read_registers_coalesced(start_address, stop_address, slave, block_size)
+    else:
+        registers = read_registers_regions(start_address, stop_address, slave, block_size, ranges)
+    output_sink.header(REGISTER_TITLES, REGISTER_TYPES)
+    for idx, value in decode_stage(registers):
+        if value is not None:
+            output_sink.row(format_register_row(idx - start_address, idx, value))
+        elif not noerror:
+            output_sink.error_row(idx)
+
+# Read parameter blocks, yields (address, registers) with registers None on error
+# Several blocks are read with one request, a failing request is split down to single blocks.
+def read_parameter_blocks(start_address, stop_address, slave):
+    if stop_address < start_address:
+        return
+    last_address = start_address + (stop_address - start_address) // PARAMETER_BLOCK_SIZE * PARAMETER_BLOCK_SIZE + PARAMETER_BLOCK_SIZE - 1
+    registers = []
+    for address, value in read_registers_coalesced(start_address, last_address, slave, args.block_size, PARAMETER_BLOCK_SIZE):
+        registers.append(value)
+        if len(registers) == PARAMETER_BLOCK_SIZE:
+            yield address - PARAMETER_BLOCK_SIZE + 1, None if None in registers else registers
+            registers = []
+
+# Value with precision applied or the text of the enum
+def format_value(parameter, lang):
+    if parameter.multi_id != 0:
+        return get_enum_text(parameter.multi_id, parameter.value, lang)
+    return parameter.scale(parameter.value)
+
+OVUM_TITLES = ["AddrHex", "AddrDec", "Param", "Int32", "Prec", "Value", "Unit", "UnitID", "MultiID", "MinVal", "MaxVal", "ReadOnly", "isMenu", "DescID", "Desc"]
+OVUM_TYPES = ["string", "integer", "string", "integer", "integer", "any", "string", "integer", "integer", "number", "number", "boolean", "boolean", "integer", "string"]
+OVUM_TITLES_MIN = ["Param", "Value", "Unit", "Desc"]
+OVUM_TYPES_MIN = ["string", "any", "string", "string"]
+
+def format_ovum_row(parameter, lang, min):
+    descriptor_text = get_descriptor_text(parameter.descriptor_id, lang)
+    if parameter.is_menu:
+        if min:
+            return [parameter.code, "", "", descriptor_text]
+        return [f"{parameter.address:#06x}", parameter.address, parameter.code, "", "", "", "", "", "", "", "", "", True, parameter.descriptor_id, descriptor_text]
+    value = parameter.value
+    value_float = format_value(parameter, lang)
+    unit_text = get_unit(parameter.unit_id).get('expected', '')
+    multi_id = parameter.multi_id if parameter.multi_id != 0 else ""
+    if min:
+        return [parameter.code, value_float, unit_text, descriptor_text]
+    return [f"{parameter.address:#06x}", parameter.address, parameter.code, value, parameter.precision, value_float, unit_text, parameter.unit_id, multi_id, parameter.min_value(), parameter.max_value(), parameter.is_readonly, False, parameter.descriptor_id, descriptor_text]
+
+def generateOvumDump(start_address, stop_address, slave, lang, min, noerror):
+    tab_size = 16 if output_sink.format == 'tsv' else 0
     if min:
-        generate_output(separator.join(header_titles_min).expandtabs(tab_size))
+        output_sink.header(OVUM_TITLES_MIN, OVUM_TYPES_MIN, tab_size)
     else:
-        generate_output(separator.join(header_titles).expandtabs(tab_size))
-    while idx <= stop_address:
-        response, error = read_register(idx, read_count, slave)
-        if not error:
-            address_hex = response[0]['address_hex']
-            address = response[0]['address']
-            parameter = f"{response[6]['char1']}{response[6]['char2']}{response[7]['char1']}{response[7]['char2']}"
-            is_not_menu = (int(response[5]['bin'][0], 2) == 0)
-            is_readonly = (int(response[5]['bin'][1], 2) == 0) if is_not_menu else ""
-            if is_not_menu:
-                value = int(f"{response[1]['hex']}{response[0]['hex']}", 16)
-                if value & 0x80000000:
-                    value = -((value ^ 0xFFFFFFFF) + 1)
-            else:
-                value = ""
-            precision = int(response[4]['bin'][:4], 2) if is_not_menu else ""
-            value_float = round(value * 10 ** (-precision), precision) if is_not_menu else ""
-            unit_id = int(response[4]['bin'][-7:], 2) if is_not_menu else ""
-            unit_text = units.get(f'{unit_id}', {}).get('expected', '') if is_not_menu else ""
-            multi_id = response[9]['UInt16'] if (is_not_menu and (response[9]['UInt16'] != "0")) else ""
-            if is_not_menu:
-                min_val = int(f"{response[2]['hex']}", 16)
-                if min_val > 32767:
-                    min_val -= 65536
-                if (f"{response[2]['bin']}" != "1000000000000000") and (f"{response[2]['bin']}" != "0000000000000000"):
-                    min_val = round(min_val * 10 ** (-precision), precision)
-                max_val = int(f"{response[3]['hex']}", 16)
-                if max_val & 0x80000000:
-                    max_val = -((max_val ^ 0xFFFFFFFF) + 1)
-                if (f"{response[3]['bin']}" != "0111111111111111") and (f"{response[3]['bin']}" != "1111111111111111"):
-                  max_val = round(max_val * 10 ** (-precision), precision)
-            else:
-                min_val = ""
-                max_val = ""
-            descriptor_id = response[8]['UInt16']
-            matching_item = next((item for item in descriptor if f"{item['iddescriptor']}" == descriptor_id),None)
-            descriptor_text = matching_item.get("tlangalphakey", {}).get(lang, "") if matching_item else ""
-            if (multi_id != ""):
-                for item in typeMap:
-                    if f"{multi_id}" in item:
-                        for tvalue in item[f"{multi_id}"]["tvalues"]:
-                            if tvalue["in_INPUT"] == value:
-                                value_float = tvalue["alphakey"][lang]
-                                break
-                        else:
-                            value_float = ""
-                        break
-                else:
-                    value_float = ""
-            if min:
-                data = [f"{parameter}", f"{value_float}", f"{unit_text}",f"{descriptor_text}"]
-            else:
-                data = [f"{address_hex}", f"{address}", f"{parameter}", f"{value}", f"{precision}", f"{value_float}", f"{unit_text}", f"{unit_id}", f"{multi_id}" ,f"{min_val}",f"{max_val}", f"{is_readonly}", f"{is_not_menu==False}", f"{descriptor_id}", f"{descriptor_text}"]
-        else:
-            data = [f"{idx}"]
-            for _ in range(1, len(header_titles)): data.append("#err")
-        if not (error and noerror):
-          generate_output(separator.join(data).expandtabs(tab_size))
-        idx += read_count
+        output_sink.header(OVUM_TITLES, OVUM_TYPES, tab_size)
+    for idx, registers in decode_stage(read_parameter_layout(start_address, stop_address, slave)):
+        if registers is not None:
+            output_sink.row(format_ovum_row(decode_parameter(idx, registers), lang, min))
+        elif not noerror:
+            output_sink.error_row(idx)
 
-def generateOvumHASS(start_address, stop_address, slave, lang):
+# Scan interval tier of a sensor: writable parameters are slow, temperatures and power are fast
+def hass_scan_interval(parameter, device_class, intervals):
+    fast, normal, slow = intervals
+    if not parameter.is_readonly:
+        return slow
+    if device_class in HASS_FAST_CLASSES:
+        return fast
+    return normal
+
+# Group sensors of the same scan interval whose value registers can be read with one request,
+# reading over at most one parameter block in between, and only over blocks in readable (read without error)
+def group_hass_sensors(sensors, readable):
+    groups = []
+    max_gap = 2 * PARAMETER_BLOCK_SIZE - VALUE_COUNT
+    for interval in sorted({sensor['scan_interval'] for sensor in sensors}):
+        tier = sorted((sensor for sensor in sensors if sensor['scan_interval'] == interval), key=lambda sensor: int(sensor['address']))
+        runs = []
+        for sensor in tier:
+            address = int(sensor['address'])
+            if not runs or not all(block in readable for block in range(int(runs[-1][-1]['address']) + PARAMETER_BLOCK_SIZE, address, PARAMETER_BLOCK_SIZE)):
+                runs.append([])
+            runs[-1].append(sensor)
+        for run in runs:
+            for address, count in plan_reads([(int(sensor['address']), VALUE_COUNT) for sensor in run], max_gap):
+                groups.append((address, count, interval, [sensor for sensor in run if address <= int(sensor['address']) < address + count]))
+    return sorted(groups, key=lambda group: group[0])
+
+def generateOvumHASS(start_address, stop_address, slave, lang, group=False, intervals=HASS_INTERVALS):
+    intervals = [int(interval) for interval in intervals.split(",")]
     if args.method == METHOD_TCP:
         data = {"host": f"{args.host}", "port": f"{args.port}"}
         generate_output(get_hass_modbustcp_def(data))
     if args.method == METHOD_RTU:
         data = {"comport": f"{args.comport}", "baudrate": f"{args.baudrate}", "parity": f"{args.parity}", "stopbits": f"{args.stopbits}"}
         generate_output(get_hass_modbusrtu_def(data))
-    read_count = 10
-    idx = start_address
-    sensor_str = ""
-    tempsens_str = "      template:\n"
+    sensors = []
+    templates = []
     last_menu = ""
-    while idx <= stop_address:
-        response, error = read_register(idx, read_count, slave)
-        if not error:
-            is_not_menu = (int(response[5]['bin'][0], 2) == 0)
-            parameter = re.sub(r'[^a-zA-Z0-9]', '',f"{response[6]['char1']}{response[6]['char2']}{response[7]['char1']}{response[7]['char2']}")
-            parameter = parameter.strip()
-            descriptor_id = response[8]['UInt16']
-            matching_item = next((item for item in descriptor if f"{item['iddescriptor']}" == descriptor_id), None)
-            descriptor_text = matching_item.get("tlangalphakey", {}).get(lang, "") if matching_item else ""
-            if is_not_menu:
-                address = response[0]['address']
-                precision = int(response[4]['bin'][:4], 2)
-                scale = round(1 * 10 ** (-precision), precision)
-                descriptor_text = f"{last_menu}: {descriptor_text} ({parameter} #{address})"
-                sensor = slugify(descriptor_text, separator="_")
-                unit_id = int(response[4]['bin'][-7:], 2)
-                unit_text = units.get(f'{unit_id}', {}).get('default', '')
-                if unit_text == "": unit_text = units.get(f'{unit_id}', {}).get('expected', '')
-                deviceclass_text = units.get(f'{unit_id}', {}).get('device_class', '')
-                deviceclass_text = f"device_class: {deviceclass_text}" if (deviceclass_text != "None") and (deviceclass_text.strip() != "") else ""
-                if is_not_menu:
-                    min_val = response[2]['Int16']
-                    max_val = response[3]['Int16']
-                    if max_val < min_val:
-                        max_val = response[3]['UInt16']
-                else:
-                    min_val = ""
-                    max_val = ""
-                multi_id = response[9]['UInt16'] if (is_not_menu and (response[9]['UInt16'] != "0")) else ""
-                isEnumValue = True if (multi_id != "") else False
-                map = ""
-                range = ""
-                if isEnumValue:
-                    for item in typeMap:
-                        if f"{multi_id}" in item:
-                            for tvalue in item[f"{multi_id}"]["tvalues"]:
-                                if len(map) > 0: map += ",\n" + "\t\t\t\t\t"
-                                if tvalue["alphakey"][lang] is None:
-                                  map += "'" + str(tvalue["in_INPUT"]) + "' : ''"
-                                else:
-                                    map += "'" + str(tvalue["in_INPUT"]) + "' : '" + tvalue["alphakey"][lang] + "'"
-                                if len(range) > 0: range += ","
-                                range += str(tvalue["in_INPUT"])
-
-                data = {"sensor": f"{sensor}", "range": f"{range}", "map": f"{map}", "slave": f"{slave}", "description": f"{descriptor_text.strip()}", "parameter": f"{parameter}", "address": f"{address}", "scale": f"{scale}", "precision": f"{precision}", "unit": f"{unit_text}", "device_class": f"{deviceclass_text}", "min_val": f"{min_val}", "max_val": f"{max_val}"}
-                sensor_str += f"{get_hass_sensor_def(data)}\n"
-                if isEnumValue and (len(range)>0):
-                    tempsens_str += f"{get_hass_templatesensor_def(data)}\n"
+    readable = set()
+    for idx, registers in decode_stage(read_parameter_layout(start_address, stop_address, slave, False)):
+        if registers is None:
+            continue
+        readable.add(idx)
+        parameter = decode_parameter(idx, registers)
+        code = re.sub(r'[^a-zA-Z0-9]', '', parameter.code).strip()
+        descriptor_text = get_descriptor_text(parameter.descriptor_id, lang)
+        if not parameter.is_menu:
+            address = parameter.address
+            precision = parameter.precision
+            scale = parameter.scale(1)
+            descriptor_text = f"{last_menu}: {descriptor_text} ({code} #{address})"
+            sensor = slugify(descriptor_text, separator="_")
+            unit = get_unit(parameter.unit_id)
+            unit_text = unit.get('default', '')
+            if unit_text == "": unit_text = unit.get('expected', '')
+            device_class = unit.get('device_class', '')
+            deviceclass_text = f"device_class: {device_class}" if (device_class != "None") and (device_class.strip() != "") else ""
+            min_val = parameter.min_raw
+            max_val = to_int16(parameter.max_raw)
+            if max_val < min_val:
+                max_val = parameter.max_raw
+            isEnumValue = parameter.multi_id != 0
+            map = ""
+            range = ""
+            enum = get_enum(parameter.multi_id) if isEnumValue else None
+            if enum:
+                for in_input, alphakey in enum["tvalues"]:
+                    if len(map) > 0: map += ",\n" + "\t\t\t\t\t"
+                    if alphakey[lang] is None:
+                      map += "'" + str(in_input) + "' : ''"
+                    else:
+                        map += "'" + str(in_input) + "' : '" + alphakey[lang] + "'"
+                    if len(range) > 0: range += ","
+                    range += str(in_input)
+
+            data = {"sensor": f"{sensor}", "range": f"{range}", "map": f"{map}", "slave": f"{slave}", "description": f"{descriptor_text.strip()}", "parameter": f"{code}", "address": f"{address}", "scale": f"{scale}", "precision": f"{precision}", "unit": f"{unit_text}", "device_class": f"{deviceclass_text}", "min_val": f"{min_val}", "max_val": f"{max_val}", "scan_interval": hass_scan_interval(parameter, device_class, intervals)}
+            if group:
+                sensors.append(data)
             else:
-                if descriptor_text is None or descriptor_text == "":
-                    last_menu = descriptor_text
-                else:
-                    last_menu = descriptor_text.capitalize()
-        idx += read_count
-    generate_output(sensor_str)
-    generate_output(tempsens_str)
+                output_sink.write(f"{get_hass_sensor_def(data)}\n")
+                sensors.append({"scan_interval": data["scan_interval"]})
+            if isEnumValue and (len(range)>0):
+                templates.append(f"{get_hass_templatesensor_def(data)}\n")
+        else:
+            if descriptor_text is None or descriptor_text == "":
+                last_menu = descriptor_text
+            else:
+                last_menu = descriptor_text.capitalize()
+    requests = sum(60 / sensor["scan_interval"] for sensor in sensors)
+    if group:
+        requests = 0
+        for address, count, interval, members in group_hass_sensors(sensors, readable):
+            requests += 60 / interval
+            if len(members) == 1:
+                output_sink.write(f"{get_hass_sensor_def(members[0])}\n")
+                continue
+            name = f"Ovum group {address}"
+            output_sink.write(f"{get_hass_groupsensor_def({'name': name, 'unique_id': f'ovum_group{address}', 'address': address, 'scan_interval': interval, 'virtual_count': (count + 1) // 2 - 1, 'slave': slave})}\n")
+            for member in members:
+                # value n of the group: the group sensor itself (n = 0) or its virtual sensor n (1..virtual_count)
+                index = (int(member['address']) - address) // 2
+                member['group_sensor'] = slugify(name if index == 0 else f"{name} {index}", separator="_")
+                templates.append(f"{get_hass_valuetemplate_def(member)}\n")
+    print(f"Home Assistant requests per minute: {len(sensors) * 60 / HASS_LEGACY_INTERVAL:.0f} with one sensor per parameter every {HASS_LEGACY_INTERVAL}s, {requests:.0f} with this configuration", file=sys.stderr)
+    output_sink.write("\n")
+    output_sink.write("      template:\n")
+    output_sink.write("".join(templates))
+    output_sink.write("\n")
+
+# Merge register ranges [(address, count)] into reads of up to max_count registers (the probed block size),
+# ranges are merged if at most max_gap registers lie between them
+def plan_reads(ranges, max_gap, max_count=None):
+    max_count = max_count or transport["max_count"]
+    reads = []
+    for address, count in sorted(ranges):
+        if reads:
+            read_address, read_count = reads[-1]
+            gap = address - (read_address + read_count)
+            if gap <= max_gap and address + count - read_address <= max_count:
+                reads[-1] = (read_address, max(read_count, address + count - read_address))
+                continue
+        reads.append((address, count))
+    return reads
+
+# Read chunks [(address, count)] without splitting, returns [(address, count, registers)] with registers None on error
+def read_chunks(chunks, slave):
+    if args.async_scan:
+        return list(read_chunks_async(chunks, slave, MAX_READ_COUNT))
+    results = []
+    for address, count in chunks:
+        registers, error = read_block(address, count, slave)
+        results.append((address, count, None if error else registers))
+    return results
+
+# Read the values of the parameters, returns {address: value} of the readable parameters
+def read_values(parameters, reads, slave):
+    results = read_chunks(reads, slave)
+    registers = {}
+    for address, count, values in results:
+        if values is not None:
+            registers.update(zip(range(address, address + count), values))
+    values = {}
+    for parameter in parameters:
+        low = registers.get(parameter.address)
+        high = registers.get(parameter.address + 1)
+        if low is not None and high is not None:
+            values[parameter.address] = struct.unpack('<i', struct.pack('<HH', low, high))[0]
+    return values
+
+def layout_key(start_address, stop_address, slave):
+    connection = f"{args.host}:{args.port}" if args.method == METHOD_TCP else f"{args.comport}"
+    return f"{args.method}_{connection}_{slave}_{start_address}_{stop_address}"
+
+def layout_filename(key):
+    return os.path.join(args.cache_dir, f"ovLayout-{slugify(key, separator='_')}.json")
+
+# Metadata registers (2-9) of a few sampled blocks, to detect a changed parameter table
+def layout_samples(blocks):
+    readable = [address for address, registers in blocks if registers is not None]
+    if not readable:
+        return []
+    return sorted({readable[i * (len(readable) - 1) // max(1, LAYOUT_SAMPLES - 1)] for i in range(LAYOUT_SAMPLES)})
+
+def layout_fingerprint(samples):
+    digest = hashlib.sha1()
+    for address, registers in samples:
+        digest.update(struct.pack(f'<{PARAMETER_BLOCK_SIZE - 1}H', address & 0xFFFF, *registers[VALUE_COUNT:PARAMETER_BLOCK_SIZE]))
+    return digest.hexdigest()
+
+# Cached blocks with zero values and the fingerprint, None without a valid cache file
+def load_layout(key):
+    try:
+        with open(layout_filename(key), "r", encoding='UTF-8') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != LAYOUT_CACHE_VERSION or cache.get("key") != key:
+        return None
+    return [(block[0], [0] * VALUE_COUNT + block[1:] if len(block) > 1 else None) for block in cache["blocks"]], cache.get("fingerprint")
+
+def save_layout(key, blocks):
+    samples = dict(blocks)
+    fingerprint = layout_fingerprint([(address, samples[address]) for address in layout_samples(blocks)])
+    cache = {"version": LAYOUT_CACHE_VERSION, "key": key, "fingerprint": fingerprint, "blocks": [[address] + (registers[VALUE_COUNT:] if registers is not None else []) for address, registers in blocks]}
+    filename = layout_filename(key)
+    try:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        with open(f"{filename}.tmp", "w", encoding='UTF-8') as file:
+            json.dump(cache, file, separators=(',', ':'))
+        os.replace(f"{filename}.tmp", filename)
+    except OSError as e:
+        print(f"Error: Could not write layout cache '{filename}': {e}", file=sys.stderr)
+
+# Parameter blocks from the layout cache (--cache) or a full scan, yields (address, registers) with registers None on error.
+# The sampled blocks of the fingerprint are read whole within the value reads. When the value reads of a layout
+# without failing blocks take as many requests as a full scan, the full scan is made instead.
+# Without with_values the value registers of cached blocks are 0.
+def read_parameter_layout(start_address, stop_address, slave, with_values=True):
+    if not (args.cache or args.rescan):
+        yield from read_parameter_blocks(start_address, stop_address, slave)
+        return
+    key = layout_key(start_address, stop_address, slave)
+    cache = None if args.rescan else load_layout(key)
+    if cache is not None:
+        blocks, fingerprint = cache
+        samples = layout_samples(blocks)
+        if with_values:
+            ranges = [(address, PARAMETER_BLOCK_SIZE if address in samples else VALUE_COUNT) for address, registers in blocks if registers is not None]
+            reads = plan_reads(ranges, max(args.max_gap or 0, PARAMETER_BLOCK_SIZE - VALUE_COUNT))
+            blocks_per_read = max(1, min(args.block_size, transport["max_count"]) // PARAMETER_BLOCK_SIZE)
+            full_scan = -(-((stop_address - start_address) // PARAMETER_BLOCK_SIZE + 1) // blocks_per_read)
+            # a full scan over failing blocks takes more requests than its chunks, the cache avoids the splits
+            if len(reads) >= full_scan and all(registers is not None for _, registers in blocks):
+                cache = None
+        else:
+            reads = plan_reads([(address, PARAMETER_BLOCK_SIZE) for address in samples], 0)
+    if cache is not None:
+        values = {}
+        for address, count, registers in read_chunks(reads, slave):
+            if registers is not None:
+                values.update(zip(range(address, address + count), registers))
+        sampled = [(address, [values.get(idx) for idx in range(address, address + PARAMETER_BLOCK_SIZE)]) for address in samples]
+        if any(None in registers for _, registers in sampled) or layout_fingerprint(sampled) != fingerprint:
+            cache = None
+    if cache is None:
+        blocks = list(read_parameter_blocks(start_address, stop_address, slave))
+        save_layout(key, blocks)
+        yield from blocks
+        return
+    for address, registers in blocks:
+        if with_values and registers is not None:
+            if address in values and address + 1 in values:
+                registers[0] = values[address]
+                registers[1] = values[address + 1]
+            else:
+                registers = None
+        yield address, registers
+
+# Ovum parameter blocks start at DEFAULT_START_ADDRESS, discovery splits on this 10-register grid
+def align_up(address):
+    return address + (DEFAULT_START_ADDRESS - address) % PARAMETER_BLOCK_SIZE
+
+def region_key(slave):
+    connection = f"{args.host}:{args.port}" if args.method == METHOD_TCP else f"{args.comport}"
+    return f"{args.method}_{connection}_{slave}"
+
+def region_filename(key):
+    return os.path.join(args.cache_dir, f"ovRegions-{slugify(key, separator='_')}.json")
+
+# Merge [(address, count)] of live registers into contiguous regions
+def merge_regions(ranges):
+    regions = []
+    for address, count in sorted(ranges):
+        if regions and address <= regions[-1][0] + regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], address + count - regions[-1][0]))
+        else:
+            regions.append((address, count))
+    return regions
+
+# Survey address..address+count-1: a failing range is split in halves on the 10-register grid of the
+# parameter blocks down to single blocks. Readable ranges are added to live, failing blocks to dead.
+def survey_range(address, count, slave, live, dead):
+    _, error = read_block(address, count, slave)
+    if not error:
+        live.append((address, count))
+        return
+    if count <= PARAMETER_BLOCK_SIZE:
+        dead.append((address, count))
+        return
+    middle = align_up(address + count // 2 - PARAMETER_BLOCK_SIZE // 2)
+    if not address < middle < address + count:
+        middle = address + count // 2
+    survey_range(address, middle - address, slave, live, dead)
+    survey_range(middle, address + count - middle, slave, live, dead)
+
+# Live regions of start_address..stop_address, read in aligned chunks of the probed block size.
+# A failing block is only resolved register by register next to a live register, live registers inside
+# failing blocks without a live neighbour are only found with --discover_all, which reads them all.
+def survey_regions(start_address, stop_address, slave):
+    if args.discover_all:
+        return merge_regions([(idx, 1) for idx, value in read_registers_coalesced(start_address, stop_address, slave, transport["max_count"]) if value is not None])
+    block_size = max(PARAMETER_BLOCK_SIZE, transport["max_count"] // PARAMETER_BLOCK_SIZE * PARAMETER_BLOCK_SIZE)
+    live = []
+    dead = []
+    address = start_address
+    while address <= stop_address:
+        end = min(stop_address + 1, align_up(address + block_size - PARAMETER_BLOCK_SIZE + 1))
+        survey_range(address, end - address, slave, live, dead)
+        address = end
+    starts = {address for address, _ in live}
+    ends = {address + count for address, count in live}
+    # forward for the blocks after a live register, backward for the blocks before one
+    resolved = set()
+    for blocks in (dead, dead[::-1]):
+        for address, count in blocks:
+            if address in resolved or not (address in ends or address + count in starts):
+                continue
+            resolved.add(address)
+            for idx, value in read_split(address, count, slave, 1, {"units": 0}):
+                if value is not None:
+                    live.append((idx, 1))
+                    starts.add(idx)
+                    ends.add(idx + 1)
+    if len(dead) > len(resolved):
+        print(f"Warning: {len(dead) - len(resolved)} failing blocks without a live neighbour were not read register by register, use --discover_all to find live registers inside them", file=sys.stderr)
+    return merge_regions(live)
+
+def load_regions(slave):
+    try:
+        with open(region_filename(region_key(slave)), "r", encoding='UTF-8') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != REGION_CACHE_VERSION or cache.get("key") != region_key(slave):
+        return None
+    return cache
+
+def save_regions(slave, start_address, stop_address, regions):
+    cache = {"version": REGION_CACHE_VERSION, "key": region_key(slave), "start": start_address, "stop": stop_address, "regions": [list(region) for region in regions]}
+    filename = region_filename(region_key(slave))
+    try:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        with open(f"{filename}.tmp", "w", encoding='UTF-8') as file:
+            json.dump(cache, file, separators=(',', ':'))
+        os.replace(f"{filename}.tmp", filename)
+    except OSError as e:
+        print(f"Error: Could not write region map '{filename}': {e}", file=sys.stderr)
+
+# Ranges of start_address..stop_address to read with the region map of --discover: the live regions
+# and everything outside the surveyed addresses, None without a region map
+def region_ranges(start_address, stop_address, slave):
+    cache = load_regions(slave)
+    if cache is None:
+        return None
+    ranges = [(address, count) for address, count in cache["regions"]]
+    if start_address < cache["start"]:
+        ranges.append((start_address, cache["start"] - start_address))
+    if stop_address > cache["stop"]:
+        ranges.append((cache["stop"] + 1, stop_address - cache["stop"]))
+    clipped = []
+    for address, count in merge_regions(ranges):
+        first = max(address, start_address)
+        last = min(address + count - 1, stop_address)
+        if first <= last:
+            clipped.append((first, last - first + 1))
+    return clipped
+
+REGION_TITLES = ["StartHex", "Start", "Stop", "Count"]
+REGION_TYPES = ["string", "integer", "integer", "integer"]
+
+def generateRegionDiscovery(start_address, stop_address, slave):
+    regions = survey_regions(start_address, stop_address, slave)
+    save_regions(slave, start_address, stop_address, regions)
+    output_sink.header(REGION_TITLES, REGION_TYPES)
+    for address, count in regions:
+        output_sink.row([f"{address:#06x}", address, address + count - 1, count])
+    print(f"Discovered {len(regions)} regions with {sum(count for _, count in regions)} registers, region map written to {region_filename(region_key(slave))}", file=sys.stderr)
+
+def store_filename(slave):
+    return os.path.join(args.store, f"ovStore-{slugify(region_key(slave), separator='_')}.bin")
+
+# Time series store of the monitored parameters, imported here as ovStore imports this module
+def open_store(slave, blocks):
+    import ovStore
+    filename = store_filename(slave)
+    try:
+        os.makedirs(args.store, exist_ok=True)
+        return ovStore.OvumStore.open_for(filename, blocks)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not open store '{filename}': {e}", file=sys.stderr)
+        raise SystemExit(1)
+
+MONITOR_TITLES = ["Time", "AddrDec", "Param", "Int32", "Value", "Unit", "Desc"]
+MONITOR_TYPES = ["string", "integer", "string", "integer", "any", "string", "string"]
+
+def generateOvumMonitor(start_address, stop_address, slave, lang, interval, polls, max_gap):
+    parameters = []
+    blocks = []
+    for idx, registers in decode_stage(read_parameter_layout(start_address, stop_address, slave)):
+        if registers is not None:
+            parameter = decode_parameter(idx, registers)
+            if not parameter.is_menu:
+                parameters.append(parameter)
+                blocks.append((idx, registers))
+    store = open_store(slave, blocks) if args.store else None
+    max_gap = value_gap() if max_gap is None else max_gap
+    reads = plan_reads([(parameter.address, VALUE_COUNT) for parameter in parameters], max_gap)
+    print(f"Monitoring {len(parameters)} parameters with {len(reads)} requests and {sum(count for _, count in reads)} registers per poll (gap {max_gap})", file=sys.stderr)
+    output_sink.header(MONITOR_TITLES, MONITOR_TYPES)
+    last_values = {}
+    poll = 0
+    try:
+        while polls == 0 or poll < polls:
+            poll_start = time.monotonic()
+            timestamp = datetime.now().astimezone().isoformat(timespec='seconds')
+            values = read_values(parameters, reads, slave) if poll > 0 else {parameter.address: parameter.value for parameter in parameters}
+            if store:
+                store.append(time.time(), [values.get(parameter.address) for parameter in parameters])
+            for parameter in parameters:
+                value = values.get(parameter.address)
+                if value is None or last_values.get(parameter.address) == value:
+                    continue
+                parameter.value = value
+                last_values[parameter.address] = value
+                descriptor_text = get_descriptor_text(parameter.descriptor_id, lang)
+                unit_text = get_unit(parameter.unit_id).get('expected', '')
+                value_text = format_value(parameter, lang)
+                output_sink.row([timestamp, parameter.address, parameter.code, value, value_text, unit_text, descriptor_text])
+            output_sink.flush()
+            if args.metrics:
+                write_metrics(args.metrics)
+            poll += 1
+            if polls == 0 or poll < polls:
+                time.sleep(max(0, interval - (time.monotonic() - poll_start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store:
+            store.close()
+
+# Write raw registers with one request (function code 16), returns an error text or None.
+# Lost responses and busy devices are retried as for reads, writing the same registers again is harmless.
+def write_block(address, values, slave):
+    error = "no response"
+    for attempt in range(args.retries + 1):
+        if attempt:
+            read_stats["retries"] += 1
+            time.sleep(backoff_delay(attempt))
+        elif transport["delay"]:
+            time.sleep(transport["delay"])
+        set_client_timeout(request_timeout(attempt, len(values)))
+        start_time = time.perf_counter()
+        try:
+            response = client.write_registers(address, values, slave)
+        except ModbusException as e:
+            response = None
+        elapsed = time.perf_counter() - start_time
+        read_stats["seconds"] += elapsed
+        record_request(elapsed, len(values), response)
+        if response is None or isinstance(response, ModbusIOException):
+            read_stats["errors"] += 1
+            transport_lost()
+            if args.method == METHOD_TCP:
+                client.close()
+            continue
+        update_transport(elapsed - frame_time(len(values)))
+        if isinstance(response, ExceptionResponse):
+            read_stats["errors"] += 1
+            error = f"exception {response.exception_code} ({EXCEPTION_TEXTS.get(response.exception_code, 'unknown')})"
+            if response.exception_code == EXCEPTION_BUSY:
+                continue
+            return error
+        return None
+    return error
+
+# Group {address: register} into writes of contiguous registers, [(address, [registers])]
+def plan_writes(registers):
+    writes = []
+    for address in sorted(registers):
+        if writes and writes[-1][0] + len(writes[-1][1]) == address and len(writes[-1][1]) < MAX_WRITE_COUNT:
+            writes[-1][1].append(registers[address])
+        else:
+            writes.append((address, [registers[address]]))
+    return writes
+
+# Parameter values of a profile as [(parameter, value)] in file order. The parameter is a code or an address.
+# YAML: a mapping {parameter: value}. CSV/TSV: parameter and value per line, or a header with Param or AddrDec
+# and Value, so the output of the Ovum map (--csv) can be written back. Lines without a value are skipped.
+def load_profile(filename):
+    if filename.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML profiles need PyYAML (pip install pyyaml)")
+        with open(filename, "r", encoding='UTF-8') as file:
+            data = yaml.safe_load(file) or {}
+        if not isinstance(data, dict):
+            raise ValueError("the YAML profile must be a mapping of parameter: value")
+        return [(f"{key}", value) for key, value in data.items()]
+    with open(filename, "r", encoding='UTF-8', newline='') as file:
+        lines = [line for line in file if line.strip() and not line.lstrip().startswith('#')]
+    if not lines:
+        return []
+    delimiter = '\t' if '\t' in lines[0] else ';' if ';' in lines[0] else ','
+    rows = [[field.strip() for field in row] for row in csv.reader(lines, delimiter=delimiter)]
+    key_column, value_column = 0, 1
+    if "Value" in rows[0]:
+        key_column = rows[0].index("AddrDec") if "AddrDec" in rows[0] else rows[0].index("Param")
+        value_column = rows[0].index("Value")
+        rows = rows[1:]
+    entries = []
+    for row in rows:
+        if len(row) <= max(key_column, value_column):
+            raise ValueError(f"missing value in line '{delimiter.join(row)}'")
+        if row[value_column] != "":
+            entries.append((row[key_column], row[value_column]))
+    return entries
+
+# Raw Int32 of an engineering value: enums by text (any language) or number, numbers with the precision
+# of the parameter and within min/max. The limits -32768 and 32767/65535 are not checked.
+def parse_write_value(parameter, value):
+    if parameter.multi_id != 0:
+        enum = get_enum(parameter.multi_id) or {"tvalues": []}
+        text = f"{value}".strip()
+        for in_input, alphakey in enum["tvalues"]:
+            if text == f"{in_input}" or text in (alphakey or {}).values():
+                return int(in_input)
+        raise ValueError(f"'{text}' is not a value of the enum")
+    try:
+        number = Decimal(f"{value}".strip().replace(',', '.'))
+        raw = number.scaleb(parameter.precision)
+    except InvalidOperation:
+        raise ValueError(f"'{value}' is not a number")
+    if raw != raw.to_integral_value():
+        raise ValueError(f"{value} has more than {parameter.precision} decimals")
+    raw = int(raw)
+    if not -0x80000000 <= raw <= 0x7FFFFFFF:
+        raise ValueError(f"{value} is out of the Int32 range")
+    if parameter.min_raw != -0x8000 and raw < parameter.min_raw:
+        raise ValueError(f"{value} is below the minimum {parameter.min_value()}")
+    # the maximum as in generateOvumHASS: Int16, unless that is below the minimum
+    max_raw = to_int16(parameter.max_raw)
+    if max_raw < parameter.min_raw:
+        max_raw = parameter.max_raw
+    if parameter.max_raw not in (0x7FFF, 0xFFFF) and raw > max_raw:
+        raise ValueError(f"{value} is above the maximum {parameter.scale(max_raw)}")
+    return raw
+
+WRITE_TITLES = ["AddrDec", "Param", "Old", "New", "Int32", "Unit", "Status", "Desc"]
+WRITE_TYPES = ["integer", "string", "any", "any", "integer", "string", "string", "string"]
+
+# Write the parameter values of a profile. The layout gives precision, min/max and the read-only flag,
+# changed values are written with one request per run of contiguous registers and verified with one
+# batched read-back. Use --cache to skip the full scan of the layout.
+def generateOvumWrite(start_address, stop_address, slave, lang, filename, dry_run):
+    try:
+        entries = load_profile(filename)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read profile '{filename}': {e}", file=sys.stderr)
+        raise SystemExit(1)
+    parameters = {}
+    codes = {}
+    for idx, registers in decode_stage(read_parameter_layout(start_address, stop_address, slave)):
+        if registers is not None:
+            parameter = decode_parameter(idx, registers)
+            if not parameter.is_menu:
+                parameters[idx] = parameter
+                codes.setdefault(parameter.code.strip(), []).append(parameter)
+    results = []
+    planned = {}
+    for key, value in entries:
+        matches = [parameters[int(key)]] if key.isdigit() and int(key) in parameters else codes.get(key.strip(), [])
+        if len(matches) != 1:
+            results.append([key if key.isdigit() else "", "" if key.isdigit() else key, "", value, "", "", "not found" if not matches else "ambiguous, use the address", ""])
+            continue
+        parameter = matches[0]
+        row = [parameter.address, parameter.code, format_value(parameter, lang), value, "", get_unit(parameter.unit_id).get('expected', ''), "", get_descriptor_text(parameter.descriptor_id, lang)]
+        results.append(row)
+        if parameter.is_readonly:
+            row[6] = "read-only"
+            continue
+        try:
+            raw = parse_write_value(parameter, value)
+        except ValueError as e:
+            row[6] = f"invalid: {e}"
+            continue
+        row[4] = raw
+        if parameter.address in planned:
+            planned.pop(parameter.address)[2][6] = "overridden"
+        if raw == parameter.value:
+            row[6] = "unchanged"
+            continue
+        row[6] = "dry run" if dry_run else "ok"
+        planned[parameter.address] = (parameter, raw, row)
+    writes = plan_writes({address + offset: word for address, (_, raw, _) in planned.items() for offset, word in enumerate(struct.unpack('<HH', struct.pack('<i', raw)))})
+    print(f"Writing {len(planned)} parameters with {len(writes)} requests", file=sys.stderr)
+    if not dry_run and planned:
+        failed = {}
+        for address, values in writes:
+            error = write_block(address, values, slave)
+            if error:
+                failed.update({idx: error for idx in range(address, address + len(values))})
+        written = [parameter for parameter, _, _ in planned.values()]
+        reads = plan_reads([(parameter.address, VALUE_COUNT) for parameter in written], max(args.max_gap or 0, PARAMETER_BLOCK_SIZE - VALUE_COUNT))
+        values = read_values(written, reads, slave)
+        for address, (parameter, raw, row) in planned.items():
+            if address in failed or address + 1 in failed:
+                row[6] = f"failed: {failed.get(address, failed.get(address + 1))}"
+            elif values.get(address) is None:
+                row[6] = "not verified: read-back failed"
+            elif values[address] != raw:
+                parameter.value = values[address]
+                row[6] = f"mismatch: read back {format_value(parameter, lang)}"
+        print(f"Verified with {len(reads)} requests: {sum(1 for _, _, row in planned.values() if row[6] == 'ok')} of {len(planned)} parameters written", file=sys.stderr)
+    output_sink.header(WRITE_TITLES, WRITE_TYPES)
+    for row in results:
+        output_sink.row(row)
 
 def doDevThings(lang):
     return None
 
-# Main function to call after script starts
-def main():
-    global args, client, descriptor, units, typeMap
+# Fall back to the synchronous scan where --async_scan is not available: RTU, --discover and --write
+def check_async_scan():
+    if args.async_scan and args.method == METHOD_RTU:
+        print("Warning: --async_scan is only available for Modbus TCP, scanning synchronously", file=sys.stderr)
+        args.async_scan = False
+    if args.async_scan and args.discover:
+        print("Warning: --discover reads one request after the other, scanning synchronously", file=sys.stderr)
+        args.async_scan = False
+    if args.async_scan and args.write:
+        print("Warning: --write uses one connection for writes and the read-back, scanning synchronously", file=sys.stderr)
+        args.async_scan = False
 
-    args = init_parser().parse_args()
-    descriptor = load_json(JSON_DESCRIPTOR)
-    units = load_json(JSON_UNITS)
-    typeMap = load_json(JSON_TYPEMAP)
-    separator = ';' if args.csv else '\t'
-
-    if args.method == METHOD_RTU:
-        client, is_connected = connect_to_modbusRTU(args.comport, args.baudrate, args.parity, args.stopbits)
+# Connect as configured in args, returns (client, is_connected); the async scan opens its own client
+def connect():
+    check_async_scan()
+    if args.async_scan:
+        return None, connect_async()
+    elif args.method == METHOD_RTU:
+        return connect_to_modbusRTU(args.comport, args.baudrate, args.parity, args.stopbits, args.timeout)
     else:
-        client, is_connected = connect_to_modbusTCP(args.host, args.port)
+        return connect_to_modbusTCP(args.host, args.port, args.timeout)
 
-    if (args.output != None): save_output(args.output, "", True)
+# Run the task selected in args on the connected client
+def run():
+    global output_sink, profiler
 
-    if args.dump:
-        generateRegisterDump(args.start_address, args.stop_address, args.slave, separator, args.noerror)
+    start_time = time.perf_counter()
+    profiler = cProfile.Profile() if args.profile else None
+    output_sink = OutputSink(args.output, args.format or ('csv' if args.csv else 'jsonl' if args.json else 'tsv'))
+
+    if args.probe and not args.dev:
+        probe_block_size(args.start_address, args.slave, args.block_size)
+
+    if args.discover:
+        generateRegionDiscovery(args.start_address, args.stop_address, args.slave)
+    elif args.dump:
+        generateRegisterDump(args.start_address, args.stop_address, args.slave, args.noerror, args.block_size)
     elif args.hass:
-        generateOvumHASS(args.start_address, args.stop_address, args.slave, args.lang)
+        generateOvumHASS(args.start_address, args.stop_address, args.slave, args.lang, args.hass_group, args.hass_intervals)
+    elif args.monitor:
+        generateOvumMonitor(args.start_address, args.stop_address, args.slave, args.lang, args.interval, args.polls, args.max_gap)
+    elif args.write:
+        generateOvumWrite(args.start_address, args.stop_address, args.slave, args.lang, args.write, args.dry_run)
     elif args.dev:
         doDevThings(args.lang)
     else:
-        generateOvumDump(args.start_address, args.stop_address, args.slave, separator, args.lang, args.min, args.noerror)
+        generateOvumDump(args.start_address, args.stop_address, args.slave, args.lang, args.min, args.noerror)
+
+    output_sink.close()
+
+    if args.stats:
+        print_stats_summary(time.perf_counter() - start_time)
+    elif args.dump or args.monitor or args.discover or args.write:
+        print_read_stats()
+    if args.metrics:
+        write_metrics(args.metrics)
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print(f"Profile of decoding and formatting written to {args.profile} (python -m pstats {args.profile})", file=sys.stderr)
+
+# Main function to call after script starts
+def main():
+    global args, client, lookup
+
+    args = init_parser().parse_args()
+    lookup = load_lookup()
+
+    client, is_connected = connect()
+    run()
 
     if client: client.close()
+    close_async()
 
 # Main Call
 if __name__ == "__main__":
@@ -0,0 +1,283 @@
+#                                                  #
+#      ovSimulator.py  Local Ovum Modbus device    #
+#                                                  #
+#      Copyright 2023 MiSc                         #
+#                                                  #
+#      This code is licensed under the GPL         #
+#                                                  #
+
+import os
+import sys
+import tty
+import random
+import struct
+import asyncio
+import argparse
+import threading
+import ovModbus
+
+DEFAULT_PARAMETERS = 612
+MENU_EVERY = 12
+
+EXCEPTION_ILLEGAL_FUNCTION = 1
+EXCEPTION_ILLEGAL_ADDRESS = 2
+EXCEPTION_ILLEGAL_VALUE = 3
+EXCEPTION_GATEWAY_NO_RESPONSE = 11
+
+# Modbus RTU CRC16 (polynomial 0xA001)
+CRC_TABLE = []
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = (_crc >> 1) ^ 0xA001 if _crc & 1 else _crc >> 1
+    CRC_TABLE.append(_crc)
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return struct.pack('<H', crc)
+
+# Registers of a dump created with --dump (AddrDec and UInt16 columns), rows with errors are skipped
+def load_capture(filename):
+    registers = {}
+    with open(filename, "r", encoding='UTF-8') as file:
+        for line in file:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 7 or not columns[2].isdigit() or not columns[6].isdigit():
+                continue
+            registers[int(columns[2])] = int(columns[6])
+    return registers
+
+def encode_code(code):
+    data = code.encode('ascii')[:4].ljust(4, b' ')
+    return struct.unpack('>HH', data)
+
+# Ovum style parameter blocks with ids from the json-files, every MENU_EVERY-th block is a menu
+def synthetic_registers(count=DEFAULT_PARAMETERS, start_address=ovModbus.DEFAULT_START_ADDRESS, seed=1):
+    rnd = random.Random(seed)
+    lookup = ovModbus.load_lookup()
+    descriptor_ids = sorted(lookup["descriptors"]) or [0]
+    unit_ids = sorted(unit_id for unit_id in lookup["units"] if unit_id != 127) or [0]
+    multi_ids = sorted(multi_id for multi_id, enum in lookup["multis"].items() if enum["tvalues"])
+    registers = {}
+    for i in range(count):
+        address = start_address + i * ovModbus.PARAMETER_BLOCK_SIZE
+        code = "".join(rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz") for _ in range(4))
+        code1, code2 = encode_code(code)
+        descriptor_id = rnd.choice(descriptor_ids)
+        if i % MENU_EVERY == 0:
+            block = [0, 0, 0, 0, 0, 0x8000, code1, code2, descriptor_id, 0]
+        else:
+            flags = 0x4000 if rnd.random() < 0.3 else 0
+            if multi_ids and rnd.random() < 0.25:
+                multi_id = rnd.choice(multi_ids)
+                values = [in_input for in_input, _ in lookup["multis"][multi_id]["tvalues"]]
+                value, min_val, max_val, format_word = rnd.choice(values), min(values), max(values), 127
+            else:
+                multi_id = 0
+                precision = rnd.choice((0, 0, 1, 1, 2))
+                min_val = rnd.choice((-0x8000, 0, -200))
+                max_val = rnd.choice((0x7FFF, 1000, 5000))
+                value = rnd.randrange(max(min_val, -500), min(max_val, 5000))
+                format_word = (precision << 12) | rnd.choice(unit_ids)
+            value &= 0xFFFFFFFF
+            block = [value & 0xFFFF, value >> 16, min_val & 0xFFFF, max_val & 0xFFFF, format_word, flags, code1, code2, descriptor_id, multi_id]
+        for offset, register in enumerate(block):
+            registers[address + offset] = register
+    return registers
+
+def parse_ranges(text):
+    ranges = []
+    for part in filter(None, (part.strip() for part in text.split(","))):
+        first, _, last = part.partition("-")
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+# Simulated device: holding registers (function codes 3, 6 and 16) with configurable latency,
+# exception ranges and maximum registers per request
+class OvumSimulator:
+    def __init__(self, registers, slaves=(ovModbus.DEFAULT_SLAVE,), latency=0.0, max_count=ovModbus.MAX_READ_COUNT, exception_ranges=(), baudrate=0):
+        self.registers = registers
+        self.slaves = set(slaves)
+        self.latency = latency
+        self.max_count = max_count
+        self.exception_ranges = list(exception_ranges)
+        self.baudrate = baudrate
+        self.stats = {"requests": 0, "exceptions": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def is_valid(self, address, count):
+        if any(first <= address + count - 1 and address <= last for first, last in self.exception_ranges):
+            return False
+        return all((address + i) in self.registers for i in range(count))
+
+    def exception(self, function_code, code):
+        self.stats["exceptions"] += 1
+        return bytes((function_code | 0x80, code))
+
+    def process(self, pdu):
+        function_code = pdu[0]
+        if function_code == 3 and len(pdu) == 5:
+            address, count = struct.unpack('>HH', pdu[1:5])
+            if not 1 <= count <= self.max_count:
+                return self.exception(function_code, EXCEPTION_ILLEGAL_VALUE)
+            if not self.is_valid(address, count):
+                return self.exception(function_code, EXCEPTION_ILLEGAL_ADDRESS)
+            values = [self.registers[address + i] for i in range(count)]
+            return struct.pack(f'>BB{count}H', function_code, count * 2, *values)
+        if function_code == 6 and len(pdu) == 5:
+            address, value = struct.unpack('>HH', pdu[1:5])
+            if not self.is_valid(address, 1):
+                return self.exception(function_code, EXCEPTION_ILLEGAL_ADDRESS)
+            self.registers[address] = value
+            return pdu
+        if function_code == 16 and len(pdu) >= 6:
+            address, count, byte_count = struct.unpack('>HHB', pdu[1:6])
+            if not 1 <= count <= 123 or byte_count != count * 2 or len(pdu) != 6 + byte_count:
+                return self.exception(function_code, EXCEPTION_ILLEGAL_VALUE)
+            if not self.is_valid(address, count):
+                return self.exception(function_code, EXCEPTION_ILLEGAL_ADDRESS)
+            for i, value in enumerate(struct.unpack(f'>{count}H', pdu[6:])):
+                self.registers[address + i] = value
+            return struct.pack('>BHH', function_code, address, count)
+        return self.exception(function_code, EXCEPTION_ILLEGAL_FUNCTION)
+
+    async def respond(self, pdu, wire_bytes=0):
+        self.stats["requests"] += 1
+        response = self.process(pdu)
+        delay = self.latency
+        if self.baudrate:
+            # 11 bits per character on the serial line
+            delay += (wire_bytes + len(response) + 3) * 11 / self.baudrate
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return response
+
+    # Modbus TCP: every request is answered in its own task, so several requests can be in flight
+    async def handle_tcp(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit_id = struct.unpack('>HHHB', header)
+                pdu = await reader.readexactly(length - 1)
+                self.stats["bytes_in"] += 7 + len(pdu)
+                task = asyncio.create_task(self.answer_tcp(writer, transaction_id, protocol_id, unit_id, pdu))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer_tcp(self, writer, transaction_id, protocol_id, unit_id, pdu):
+        if unit_id in self.slaves:
+            response = await self.respond(pdu)
+        else:
+            self.stats["requests"] += 1
+            response = self.exception(pdu[0], EXCEPTION_GATEWAY_NO_RESPONSE)
+        frame = struct.pack('>HHHB', transaction_id, protocol_id, len(response) + 1, unit_id) + response
+        self.stats["bytes_out"] += len(frame)
+        if not writer.is_closing():
+            writer.write(frame)
+
+    async def serve_tcp(self, host, port, started=None):
+        server = await asyncio.start_server(self.handle_tcp, host, port)
+        if started: started(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    # Modbus RTU on the master side of a pty, requests are answered one after another
+    async def serve_rtu(self, fd, started=None):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        loop.add_reader(fd, lambda: queue.put_nowait(os.read(fd, 1024)))
+        if started: started(fd)
+        buffer = b""
+        while True:
+            buffer += await queue.get()
+            while True:
+                frame_length = self.rtu_frame_length(buffer)
+                if frame_length is None or len(buffer) < frame_length:
+                    break
+                frame, buffer = buffer[:frame_length], buffer[frame_length:]
+                if crc16(frame[:-2]) != frame[-2:]:
+                    buffer = b""
+                    break
+                self.stats["bytes_in"] += len(frame)
+                if frame[0] not in self.slaves:
+                    continue
+                response = await self.respond(frame[1:-2], len(frame))
+                response = bytes((frame[0],)) + response
+                response += crc16(response)
+                self.stats["bytes_out"] += len(response)
+                os.write(fd, response)
+
+    @staticmethod
+    def rtu_frame_length(buffer):
+        if len(buffer) < 2:
+            return None
+        if buffer[1] in (3, 6):
+            return 8
+        if buffer[1] == 16:
+            return 9 + buffer[6] if len(buffer) >= 7 else None
+        return len(buffer)
+
+# Create a pty pair, the simulator uses the master fd, the client opens the returned device
+def open_pty():
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(slave_fd)
+    return master_fd, slave_fd, os.ttyname(slave_fd)
+
+# Run the simulator in a background thread, returns the TCP port or the pty device of the RTU variant
+def run_in_thread(simulator, rtu=False, host='127.0.0.1', port=0):
+    ready = threading.Event()
+    endpoint = {}
+    def started(value):
+        endpoint["endpoint"] = value
+        ready.set()
+    def run():
+        if rtu:
+            master_fd, slave_fd, device = open_pty()
+            asyncio.run(simulator.serve_rtu(master_fd, lambda fd: started(device)))
+        else:
+            asyncio.run(simulator.serve_tcp(host, port, started))
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return endpoint["endpoint"]
+
+def init_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capture', type=str, default=None, help='Serve the registers of a dump created with --dump')
+    parser.add_argument('--parameters', type=int, default=DEFAULT_PARAMETERS, help='Number of synthetic Ovum parameter blocks')
+    parser.add_argument('--start_address', type=int, default=ovModbus.DEFAULT_START_ADDRESS, help='Start address of the synthetic parameter blocks')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic parameter blocks')
+    parser.add_argument('--slave', type=int, action='append', default=None, help='Served Modbus-Address (Slave), can be repeated')
+    parser.add_argument('--host', type=str, default=ovModbus.DEFAULT_HOST, help='Listen address for Modbus TCP')
+    parser.add_argument('--port', type=int, default=ovModbus.DEFAULT_PORT, help='Listen port for Modbus TCP')
+    parser.add_argument('--rtu', action='store_true', help='Serve Modbus RTU on a pty instead of Modbus TCP')
+    parser.add_argument('--baudrate', type=int, default=0, help='Emulate the transfer time of a serial line with this baudrate')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay in seconds per request')
+    parser.add_argument('--max_count', type=int, default=ovModbus.MAX_READ_COUNT, help='Maximum registers per request')
+    parser.add_argument('--exceptions', type=str, default="", help='Address ranges answered with an exception, e.g. 13000-13099,14000')
+    return parser
+
+def main():
+    args = init_parser().parse_args()
+    registers = load_capture(args.capture) if args.capture else synthetic_registers(args.parameters, args.start_address, args.seed)
+    simulator = OvumSimulator(registers, args.slave or [ovModbus.DEFAULT_SLAVE], args.latency, args.max_count, parse_ranges(args.exceptions), args.baudrate)
+    print(f"Serving {len(registers)} registers for slave {', '.join(str(slave) for slave in sorted(simulator.slaves))}")
+    try:
+        if args.rtu:
+            master_fd, slave_fd, device = open_pty()
+            print(f"Modbus RTU device: {device}")
+            asyncio.run(simulator.serve_rtu(master_fd))
+        else:
+            print(f"Modbus TCP: {args.host}:{args.port}")
+            asyncio.run(simulator.serve_tcp(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    print(f"Requests: {simulator.stats['requests']} (exceptions: {simulator.stats['exceptions']}), bytes in: {simulator.stats['bytes_in']}, bytes out: {simulator.stats['bytes_out']}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#                                                  #
+#      ovStore.py  Time series of Ovum parameters  #
+#                                                  #
+#      Copyright 2023 MiSc                         #
+#                                                  #
+#      This code is licensed under the GPL         #
+#                                                  #
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import bisect
+import argparse
+from datetime import datetime
+import ovModbus
+
+STORE_MAGIC = b'OVSTORE1'
+STORE_VERSION = 1
+# magic, header size, rows; the row counter is written after the values of a row
+STORE_PREFIX = struct.Struct('<8sIQ')
+ROWS_OFFSET = 12
+CHUNK_ROWS = 1024
+TIMESTAMP_SIZE = 8
+VALUE_SIZE = 4
+MISSING = -0x80000000
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Store file: prefix and JSON header with the metadata registers (2-9) of the parameters, then chunks of
+# CHUNK_ROWS polls. A chunk holds the timestamps (Int64, ms) followed by one column of raw Int32 values per
+# parameter, so a query maps only the timestamps and the column it reads. Precision, unit and enum are
+# applied when reading. Append only, timestamps never decrease.
+class OvumStore:
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        self.writable = writable
+        self.file = open(filename, "r+b" if writable else "rb")
+        magic, self.header_size, _ = STORE_PREFIX.unpack(self.file.read(STORE_PREFIX.size))
+        if magic != STORE_MAGIC:
+            raise ValueError(f"'{filename}' is not a parameter store")
+        header = json.loads(self.file.read(self.header_size - STORE_PREFIX.size).rstrip(b' '))
+        if header.get("version") != STORE_VERSION:
+            raise ValueError(f"'{filename}' has store version {header.get('version')}, expected {STORE_VERSION}")
+        self.columns = header["columns"]
+        self.addresses = [column[0] for column in self.columns]
+        self.chunk_rows = header["chunk_rows"]
+        self.chunk_size = self.chunk_rows * (TIMESTAMP_SIZE + VALUE_SIZE * len(self.columns))
+        self.map = None
+        self.view = None
+        self.remap()
+
+    # New store for the parameter blocks [(address, registers)], only the metadata registers are kept
+    @staticmethod
+    def create(filename, blocks, chunk_rows=CHUNK_ROWS):
+        columns = [[address] + list(registers[ovModbus.VALUE_COUNT:ovModbus.PARAMETER_BLOCK_SIZE]) for address, registers in blocks]
+        header = json.dumps({"version": STORE_VERSION, "chunk_rows": chunk_rows, "columns": columns}, separators=(',', ':')).encode()
+        header_size = -(-(STORE_PREFIX.size + len(header)) // TIMESTAMP_SIZE) * TIMESTAMP_SIZE
+        with open(f"{filename}.tmp", "wb") as file:
+            file.write(STORE_PREFIX.pack(STORE_MAGIC, header_size, 0) + header.ljust(header_size - STORE_PREFIX.size))
+        os.replace(f"{filename}.tmp", filename)
+        return OvumStore(filename, writable=True)
+
+    # Store of the parameter blocks, a store of another parameter table is kept under a new name
+    @staticmethod
+    def open_for(filename, blocks):
+        if os.path.exists(filename):
+            store = OvumStore(filename, writable=True)
+            if store.columns == [[address] + list(registers[ovModbus.VALUE_COUNT:ovModbus.PARAMETER_BLOCK_SIZE]) for address, registers in blocks]:
+                return store
+            store.close()
+            rotated = f"{filename}.{int(time.time())}"
+            os.replace(filename, rotated)
+            print(f"Warning: The parameters differ from the store '{filename}', moved it to '{rotated}'", file=sys.stderr)
+        return OvumStore.create(filename, blocks)
+
+    def remap(self):
+        if self.view is not None:
+            self.view.release()
+        if self.map is not None:
+            self.map.close()
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+        self.view = None if self.writable else memoryview(self.map)
+
+    # Rows in the mapped chunks, a reader may see a row counter of chunks appended after it was opened
+    @property
+    def rows(self):
+        rows = struct.unpack_from('<Q', self.map, ROWS_OFFSET)[0]
+        return min(rows, (len(self.map) - self.header_size) // self.chunk_size * self.chunk_rows)
+
+    def chunk_offset(self, chunk):
+        return self.header_size + chunk * self.chunk_size
+
+    def last_timestamp(self):
+        rows = self.rows
+        if rows == 0:
+            return None
+        chunk, slot = divmod(rows - 1, self.chunk_rows)
+        return struct.unpack_from('<q', self.map, self.chunk_offset(chunk) + slot * TIMESTAMP_SIZE)[0]
+
+    def first_timestamp(self):
+        return struct.unpack_from('<q', self.map, self.chunk_offset(0))[0] if self.rows else None
+
+    # One poll: timestamp in seconds and the raw values in column order, None for values not read
+    def append(self, timestamp, values):
+        row = self.rows
+        chunk, slot = divmod(row, self.chunk_rows)
+        offset = self.chunk_offset(chunk)
+        if offset + self.chunk_size > len(self.map):
+            self.file.truncate(offset + self.chunk_size)
+            self.remap()
+        last = self.last_timestamp()
+        timestamp = int(timestamp * 1000) if last is None else max(last, int(timestamp * 1000))
+        struct.pack_into('<q', self.map, offset + slot * TIMESTAMP_SIZE, timestamp)
+        base = offset + self.chunk_rows * TIMESTAMP_SIZE + slot * VALUE_SIZE
+        for column, value in enumerate(values):
+            struct.pack_into('<i', self.map, base + column * self.chunk_rows * VALUE_SIZE, MISSING if value is None else value)
+        struct.pack_into('<Q', self.map, ROWS_OFFSET, row + 1)
+
+    # (timestamps, values) of a column per chunk in start <= timestamp < end (ms), as views of the mapped file
+    def column_slices(self, column, start, end):
+        rows = self.rows
+        for chunk in range(-(-rows // self.chunk_rows)):
+            count = min(self.chunk_rows, rows - chunk * self.chunk_rows)
+            offset = self.chunk_offset(chunk)
+            timestamps = self.view[offset:offset + count * TIMESTAMP_SIZE].cast('q')
+            if timestamps[count - 1] < start:
+                continue
+            if timestamps[0] >= end:
+                break
+            first = bisect.bisect_left(timestamps, start)
+            last = bisect.bisect_left(timestamps, end)
+            values_offset = offset + self.chunk_rows * TIMESTAMP_SIZE + column * self.chunk_rows * VALUE_SIZE
+            yield timestamps[first:last], self.view[values_offset + first * VALUE_SIZE:values_offset + last * VALUE_SIZE].cast('i')
+
+    def samples(self, column, start, end):
+        for timestamps, values in self.column_slices(column, start, end):
+            for timestamp, value in zip(timestamps, values):
+                if value != MISSING:
+                    yield timestamp, value
+
+    # Buckets of step ms, aligned to multiples of step, as (bucket start, count, sum, min, max, last value)
+    def downsample(self, column, start, end, step):
+        bucket = None
+        for timestamps, values in self.column_slices(column, start, end):
+            i = 0
+            while i < len(timestamps):
+                bucket_start = timestamps[i] // step * step
+                j = bisect.bisect_left(timestamps, bucket_start + step, i)
+                present = [value for value in values[i:j] if value != MISSING]
+                i = j
+                if not present:
+                    continue
+                if bucket is not None and bucket[0] != bucket_start:
+                    yield tuple(bucket)
+                    bucket = None
+                if bucket is None:
+                    bucket = [bucket_start, 0, 0, present[0], present[0], None]
+                bucket[1] += len(present)
+                bucket[2] += sum(present)
+                bucket[3] = min(bucket[3], min(present))
+                bucket[4] = max(bucket[4], max(present))
+                bucket[5] = present[-1]
+        if bucket is not None:
+            yield tuple(bucket)
+
+    def parameter(self, column):
+        return ovModbus.decode_parameter(self.columns[column][0], [0] * ovModbus.VALUE_COUNT + self.columns[column][1:])
+
+    # Pages of the map are written back by the system, also if the monitor is killed
+    def close(self):
+        if self.writable:
+            self.map.flush()
+        if self.view is not None:
+            self.view.release()
+        self.map.close()
+        self.file.close()
+
+# Seconds of "90", "15m", "1h", "7d", "2w"
+def parse_duration(text):
+    if text[-1:] in DURATION_UNITS:
+        return float(text[:-1]) * DURATION_UNITS[text[-1]]
+    return float(text)
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000).astimezone().isoformat(timespec='seconds')
+
+# Columns of the parameters given as codes or addresses, e.g. "CoHo,12298"
+def select_columns(store, text):
+    columns = []
+    for name in filter(None, (name.strip() for name in text.split(","))):
+        matches = [column for column in range(len(store.columns)) if name == f"{store.addresses[column]}" or name.lower() == store.parameter(column).code.strip().lower()]
+        if not matches:
+            print(f"Error: Parameter '{name}' is not in the store", file=sys.stderr)
+            sys.exit(1)
+        columns += [column for column in matches if column not in columns]
+    return columns
+
+LIST_TITLES = ["AddrDec", "Param", "Unit", "Desc"]
+LIST_TYPES = ["integer", "string", "string", "string"]
+SERIES_TITLES = ["Time", "AddrDec", "Param", "Mean", "Min", "Max", "Last", "Samples", "Unit", "Desc"]
+SERIES_TYPES = ["string", "integer", "string", "any", "number", "number", "any", "integer", "string", "string"]
+
+def generateList(store, output_sink, lang):
+    first, last = store.first_timestamp(), store.last_timestamp()
+    if first is not None:
+        print(f"{store.rows} polls from {format_time(first)} to {format_time(last)}", file=sys.stderr)
+    output_sink.header(LIST_TITLES, LIST_TYPES)
+    for column in range(len(store.columns)):
+        parameter = store.parameter(column)
+        output_sink.row([parameter.address, parameter.code, ovModbus.get_unit(parameter.unit_id).get('expected', ''), ovModbus.get_descriptor_text(parameter.descriptor_id, lang)])
+
+# Raw samples with the columns of the monitor, or per step bucket the mean, min, max and last value.
+# Enums have no mean, their last value is shown.
+def generateSeries(store, output_sink, columns, start, end, step, lang):
+    output_sink.header(ovModbus.MONITOR_TITLES if not step else SERIES_TITLES, ovModbus.MONITOR_TYPES if not step else SERIES_TYPES)
+    for column in columns:
+        parameter = store.parameter(column)
+        unit_text = ovModbus.get_unit(parameter.unit_id).get('expected', '')
+        descriptor_text = ovModbus.get_descriptor_text(parameter.descriptor_id, lang)
+        if not step:
+            for timestamp, value in store.samples(column, start, end):
+                parameter.value = value
+                output_sink.row([format_time(timestamp), parameter.address, parameter.code, value, ovModbus.format_value(parameter, lang), unit_text, descriptor_text])
+            continue
+        for bucket_start, count, total, low, high, last in store.downsample(column, start, end, step):
+            parameter.value = last
+            last_text = ovModbus.format_value(parameter, lang)
+            if parameter.multi_id != 0:
+                output_sink.row([format_time(bucket_start), parameter.address, parameter.code, "", "", "", last_text, count, unit_text, descriptor_text])
+            else:
+                output_sink.row([format_time(bucket_start), parameter.address, parameter.code, parameter.scale(total / count), parameter.scale(low), parameter.scale(high), last_text, count, unit_text, descriptor_text])
+
+def init_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', type=str, help='Store file written by ovModbus.py --monitor --store')
+    parser.add_argument('--list', action='store_true', help='List the parameters and the time range of the store')
+    parser.add_argument('--param', type=str, default="", help='Parameter codes or addresses to read, e.g. CoHo,12298')
+    parser.add_argument('--last', type=str, default=None, help='Time range up to now, e.g. 30m, 12h, 7d')
+    parser.add_argument('--start', type=str, default=None, help='Start time (ISO 8601)')
+    parser.add_argument('--end', type=str, default=None, help='End time (ISO 8601), default now')
+    parser.add_argument('--step', type=str, default=None, help='Downsample to buckets of this duration, e.g. 15m, 1h, 1d')
+    parser.add_argument('--lang', type=str, default=ovModbus.DEFAULT_LANG, help='Language Selector (de, en, ...)')
+    parser.add_argument('--format', type=str, choices=ovModbus.OUTPUT_FORMATS, default='tsv', help='Output format: tsv (default), csv, jsonl or ndjson')
+    parser.add_argument('--output', type=str, default=None, help='Write output to a file')
+    return parser
+
+def main():
+    args = init_parser().parse_args()
+    try:
+        store = OvumStore(args.store)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not open store: {e}", file=sys.stderr)
+        sys.exit(1)
+    ovModbus.lookup = ovModbus.load_lookup()
+    output_sink = ovModbus.OutputSink(args.output, args.format)
+    if args.list or not args.param:
+        generateList(store, output_sink, args.lang)
+    else:
+        end = datetime.fromisoformat(args.end).timestamp() if args.end else time.time()
+        if args.start:
+            start = datetime.fromisoformat(args.start).timestamp()
+        else:
+            start = end - parse_duration(args.last) if args.last else 0
+        step = int(parse_duration(args.step) * 1000) if args.step else 0
+        generateSeries(store, output_sink, select_columns(store, args.param), int(start * 1000), int(end * 1000), step, args.lang)
+    output_sink.close()
+
+if __name__ == "__main__":
+    main()